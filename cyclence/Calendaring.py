@@ -20,20 +20,22 @@
 from __future__ import print_function
 
 from datetime import date, timedelta, datetime
+from functools import partial
 from itertools import count
 from math import ceil
 from uuid import uuid4
-from hashlib import md5
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.dialects.postgresql import UUID, INTERVAL
-from sqlalchemy.orm import relationship, column_property
+from sqlalchemy.orm import relationship, column_property, backref
 from sqlalchemy.orm.session import object_session
-from sqlalchemy import (Column, Integer, String, Boolean, Date, DateTime,
-                        ForeignKey, Table, select, func)
+from sqlalchemy import (Column, Integer, BigInteger, String, Boolean, Date,
+                        DateTime, Float, ForeignKey, Table, Index, select,
+                        func, text, cast, case, literal, and_, not_)
 
-from cyclence import utils
+from cyclence import utils, events
 
 CyclenceBase = declarative_base()
 
@@ -41,25 +43,79 @@ DUE = 'due'
 OVERDUE = 'overdue'
 NOT_DUE = 'not due'
 
+# the sections of the task list
+CURRENTLY_DUE = 'currently due'
+DUE_SOON = 'due soon'
+
 class Notification(CyclenceBase):
     r'''Represents a notification in the system'''
     __tablename__ = 'notifications'
+    __table_args__ = (Index('ix_notifications_email_timestamp',
+                            'email', 'timestamp'),)
 
     notification_id = Column(UUID, primary_key=True)
-    email = Column(String, ForeignKey('users.email'))
+    email = Column(String, ForeignKey('users.email', ondelete='CASCADE'))
     timestamp = Column(DateTime)
     message = Column(String)
     noti_type = Column(String)
-    sender = Column(String, ForeignKey('users.email'), nullable=True)
-    task_id = Column(UUID, ForeignKey('tasks.task_id'), nullable=True)
+    sender = Column(String, ForeignKey('users.email', ondelete='SET NULL'),
+                    nullable=True)
+    # not a foreign key, since the task may be on another shard
+    task_id = Column(UUID, nullable=True)
+
+    @classmethod
+    def send(cls, session, emails, noti_type, msg, task_id=None, sender=None):
+        r'''Notifies every user in `emails` with a single insert per shard.
+        Doesn't load anyone's existing notifications.'''
+        now = datetime.now()
+        rows = [dict(notification_id=str(uuid4()),
+                     email=email,
+                     timestamp=now,
+                     message=msg,
+                     noti_type=noti_type,
+                     task_id=task_id,
+                     sender=sender) for email in set(emails)]
+        if not rows:
+            return
+        session.flush() # the sender may not be in the database yet
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(other_shard(session, row['email']), [])\
+                    .append(row)
+        local = by_shard.pop(None, [])
+        sender_name = None
+        if by_shard and sender is not None:
+            sender_name = session.query(User.name)\
+                                 .filter_by(email=sender).scalar()
+        for shard, elsewhere in by_shard.items():
+            session.defer(shard, partial(cls.deliver, rows=elsewhere,
+                                         sender_name=sender_name))
+        cls.deliver(session, local)
+
+    @classmethod
+    def deliver(cls, session, rows, sender_name=None):
+        r'''Inserts notification `rows` on the recipients' shard. The sender
+        is copied there from their own shard if `sender_name` is given.'''
+        if not rows:
+            return
+        if sender_name is not None:
+            User.ghost(session, rows[0]['sender'], sender_name)
+            session.flush()
+        session.execute(cls.__table__.insert().values(rows))
+        events.publish_many(session, [
+            (row['email'], events.NOTIFICATION,
+             dict(notification_id=row['notification_id'],
+                  noti_type=row['noti_type'], message=row['message'],
+                  task_id=row['task_id']))
+            for row in rows])
 
 class Tag(CyclenceBase):
     r'''Represents a tag attached to a specific Task'''
     __tablename__ = 'tasktags'
 
-    task_id = Column(UUID, ForeignKey('tasks.task_id'),
+    task_id = Column(UUID, ForeignKey('tasks.task_id', ondelete='CASCADE'),
                      primary_key=True)
-    tag_name = Column(String, primary_key=True)
+    tag_name = Column(String, primary_key=True, index=True)
 
     def __init__(self, task_id, tag_name):
         self.task_id = task_id
@@ -75,23 +131,127 @@ class Completion(CyclenceBase):
     r'''Represents a completion of a task'''
     __tablename__ = 'completions'
 
-    task_id = Column(UUID, ForeignKey('tasks.task_id'), primary_key=True)
+    task_id = Column(UUID, ForeignKey('tasks.task_id', ondelete='CASCADE'),
+                     primary_key=True)
     completed_on = Column(Date, primary_key=True)
     points_earned = Column(Integer)
     recorded_on = Column(DateTime)
     days_late = Column(Integer)
-    email = Column(String, ForeignKey('users.email'), nullable=False,
-                   index=True)
+    # kept when the completer is deleted, since the task may still be shared
+    # by others and its due date depends on it
+    email = Column(String, ForeignKey('users.email', ondelete='SET NULL'),
+                   nullable=True, index=True)
 
     completer = relationship('User')
 
+Index('ix_completions_task_id_completed_on', Completion.__table__.c.task_id,
+      Completion.__table__.c.completed_on.desc())
 
 usertasks = Table('taskuser', CyclenceBase.metadata,
-    Column('task_id', UUID, ForeignKey('tasks.task_id'), primary_key=True),
-    Column('email', String, ForeignKey('users.email'), primary_key=True)
+    Column('task_id', UUID, ForeignKey('tasks.task_id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('email', String, ForeignKey('users.email', ondelete='CASCADE'),
+           primary_key=True, index=True)
 )
 
-class Task(CyclenceBase):
+class Recurrence(object):
+    r'''The scheduling rules for a recurring task. Needs `first_due`,
+    `length`, `allow_early`, `points`, `decay_length` and `last_completed`
+    attributes.'''
+
+    __slots__ = ()
+
+    # the day the rules are applied as of. None means today.
+    as_of = None
+
+    @property
+    def today(self):
+        return self.as_of or date.today()
+
+    @property
+    def duedate(self):
+        '''Returns the date the task is due.'''
+        last = self.last_completed
+
+        if last is None:
+            return self.first_due
+        else:
+            return last + self.length
+
+    def due_schedule(self):
+        '''An infinite generator that produces the next and future due dates of
+        this task. If the task is overdue, it only produces today.'''
+        if self.is_overdue:
+            yield self.today
+            return
+        yield self.duedate
+        for i in count(1):
+            yield self.duedate + i*self.length
+
+
+    def point_worth(self, completed_on=None):
+        '''Calculates how many points completing the task on the given date is
+        worth, given the `duedate`, when it was `completed_on`, the
+        `decay_length` and the `max_points` the task is worth'''
+        completed_on = completed_on or self.today
+        if self.duedate > completed_on and not self.allow_early:
+            return 0
+        days_off = abs((self.duedate - completed_on).days)
+        points_per_day = self.points / float(self.decay_length.days)
+        return max(0, self.points - int(ceil(points_per_day * days_off)))
+
+    @property
+    def sort_value(self):
+        r'''A single number that represents the priority of this task.'''
+        if self.is_not_due and not self.allow_early:
+            return 0
+        today = self.today
+        zero = self.duedate - self.decay_length
+        mult = max(0, (today - zero).days)
+        days_late = max(0, (today - self.duedate).days)
+        return self.points * (mult + days_late) # double count late days
+
+    @property
+    def dueity(self):
+        '''Returns a string representing the due status of this task.
+        Can be either: 'not due', 'due', or 'overdue' '''
+        today = self.today
+        duedate = self.duedate
+        if duedate < today:
+            return OVERDUE
+        elif duedate > today:
+            return NOT_DUE
+        else:
+            return DUE
+
+    @property
+    def is_due(self):
+        '''Whether this task is due'''
+        return self.dueity == DUE
+
+    @property
+    def is_overdue(self):
+        '''Whether this task is overdue'''
+        return self.dueity == OVERDUE
+
+    @property
+    def is_not_due(self):
+        '''Whether this task is not due yet'''
+        return self.dueity == NOT_DUE
+
+    @property
+    def group(self):
+        '''Which section of the task list this task belongs in. Either
+        'currently due', 'due soon' or 'not due' '''
+        if not self.is_not_due:
+            return CURRENTLY_DUE
+        elif self.allow_early and self.point_worth() > 0:
+            return DUE_SOON
+        else:
+            return NOT_DUE
+
+
+class Task(Recurrence, CyclenceBase):
     "Represents a recurring task."
 
     __tablename__ = "tasks"
@@ -108,12 +268,64 @@ class Task(CyclenceBase):
         select([func.max(Completion.completed_on)])
         .where(Completion.task_id == task_id))
 
-    users = relationship('User', secondary=usertasks,
-                         backref='tasks')
+    # rows that hang off a task are removed by the database's ON DELETE
+    # CASCADE, so deleting a task doesn't load them first
+    users = relationship('User', secondary=usertasks, passive_deletes=True,
+                         backref=backref('tasks', passive_deletes=True))
     _tags = relationship('Tag', collection_class=set,
-                         cascade="all, delete, delete-orphan")
+                         cascade="all, delete, delete-orphan",
+                         passive_deletes=True)
     completions = relationship("Completion", lazy="dynamic", backref="task",
-                               cascade="all, delete, delete-orphan")
+                               cascade="all, delete, delete-orphan",
+                               passive_deletes=True)
+
+    # SQL versions of the scheduling rules in Recurrence, so the database can
+    # sort and filter tasks. They must agree with the python versions.
+
+    duedate = hybrid_property(Recurrence.duedate.fget)
+
+    @duedate.expression
+    def duedate(cls):
+        return func.coalesce(cast(cls.last_completed + cls.length, Date),
+                             cls.first_due)
+
+    point_worth = hybrid_method(vars(Recurrence)['point_worth'])
+
+    @point_worth.expression
+    def point_worth(cls, completed_on=None):
+        if completed_on is None:
+            completed_on = date.today()
+        completed_on = literal(completed_on, Date)
+        duedate = cls.duedate
+        days_off = func.abs(duedate - completed_on)
+        points_per_day = cast(cls.points, Float) \
+                         / func.extract('day', cls.decay_length)
+        worth = func.greatest(
+            0, cls.points - cast(func.ceil(points_per_day * days_off), Integer))
+        return case([(and_(duedate > completed_on, not_(cls.allow_early)), 0)],
+                    else_=worth)
+
+    sort_value = hybrid_property(Recurrence.sort_value.fget)
+
+    @sort_value.expression
+    def sort_value(cls):
+        today = literal(date.today(), Date)
+        duedate = cls.duedate
+        decay_days = cast(func.extract('day', cls.decay_length), Integer)
+        mult = func.greatest(0, today - duedate + decay_days)
+        days_late = func.greatest(0, today - duedate)
+        return case([(and_(duedate > today, not_(cls.allow_early)), 0)],
+                    else_=cls.points * (mult + days_late))
+
+    group = hybrid_property(Recurrence.group.fget)
+
+    @group.expression
+    def group(cls):
+        today = date.today()
+        return case([(cls.duedate <= today, CURRENTLY_DUE),
+                     (and_(cls.allow_early, cls.point_worth(today) > 0),
+                      DUE_SOON)],
+                    else_=NOT_DUE)
 
     def __init__(self, name, length, first_due=None, allow_early=True,
                  points=100, decay_length=None, tags=None, notes=None):
@@ -174,35 +386,6 @@ class Task(CyclenceBase):
         t = s.query(Tag).get((self.task_id, tag_name))
         self._tags.remove(t)
 
-    @property
-    def dueity(self):
-        '''Returns a string representing the due status of this task.
-        Can be either: 'not due', 'due', or 'overdue' '''
-        today = date.today()
-        duedate = self.duedate
-        if duedate < today:
-            return OVERDUE
-        elif duedate > today:
-            return NOT_DUE
-        else:
-            return DUE
-
-    @property
-    def is_due(self):
-        '''Whether this task is due'''
-        return self.dueity == DUE
-
-    @property
-    def is_overdue(self):
-        '''Whether this task is overdue'''
-        return self.dueity == OVERDUE
-
-    @property
-    def is_not_due(self):
-        '''Whether this task is not due yet'''
-        return self.dueity == NOT_DUE
-
-
     def complete(self, completer, completed_on=None):
         '''Complete the recurring task.'''
         today = date.today()
@@ -222,7 +405,26 @@ class Task(CyclenceBase):
                        days_late = (completed_on - self.duedate).days,
                        recorded_on = today,
                        email=completer.email))
+        self.changed(completer=completer.email)
 
+    def changed(self, emails=None, **data):
+        r'''Tells every worker that this task changed for everyone sharing it,
+        or for `emails`. Sent when its session commits.'''
+        session = object_session(self)
+        if session is None:
+            return
+        if emails is None:
+            emails = [u.email for u in self.users]
+        events.publish_many(session, [
+            (email, events.TASK, dict(data, task_id=self.task_id))
+            for email in emails])
+
+    def notify_users(self, noti_type, msg, exclude=None):
+        r'''Notifies everyone sharing this task, except the user with the
+        email `exclude`'''
+        Notification.send(object_session(self),
+                          [u.email for u in self.users if u.email != exclude],
+                          noti_type, msg, task_id=self.task_id)
 
     def __repr__(self):
         return '{name} starts on {date} and recurs every {length}'\
@@ -231,53 +433,84 @@ class Task(CyclenceBase):
                     length = utils.time_str(self.length.days))
 
 
-    @property
-    def duedate(self):
-        '''Returns the date the task is due.'''
-        last = self.last_completed
-
-        if last is None:
-            return self.first_due
-        else:
-            return last + self.length
-
-    def due_schedule(self):
-        '''An infinite generator that produces the next and future due dates of
-        this task. If the task is overdue, it only produces today.'''
-        if self.is_overdue:
-            yield date.today()
-            return
-        yield self.duedate
-        for i in count(1):
-            yield self.duedate + i*self.length
+def search_vector(name, notes):
+    r'''The full text search document for a task. The same expression is used
+    for the index and for queries so that postgres can use the index.'''
+    english = text("'english'")
+    empty = text("''")
+    # grouped, since postgres needs parentheses around index expressions
+    return func.to_tsvector(english, func.coalesce(name, empty))\
+               .op('||')(func.to_tsvector(english, func.coalesce(notes, empty)))\
+               .self_group()
 
+Index('ix_tasks_search', search_vector(Task.__table__.c.name,
+                                      Task.__table__.c.notes),
+      postgresql_using='gin')
 
-    def point_worth(self, completed_on=None):
-        '''Calculates how many points completing the task on the given date is
-        worth, given the `duedate`, when it was `completed_on`, the
-        `decay_length` and the `max_points` the task is worth'''
-        completed_on = completed_on or date.today()
-        if self.duedate > completed_on and not self.allow_early:
-            return 0
-        days_off = abs((self.duedate - completed_on).days)
-        points_per_day = self.points / float(self.decay_length.days)
-        return max(0, self.points - int(ceil(points_per_day * days_off)))
+friendships = Table('friendships', CyclenceBase.metadata,
+    Column('email_1', String, ForeignKey('users.email', ondelete='CASCADE'),
+           primary_key=True),
+    Column('email_2', String, ForeignKey('users.email', ondelete='CASCADE'),
+           primary_key=True, index=True)
+)
 
-    @property
-    def sort_value(self):
-        r'''A single number that represents the priority of this task.'''
-        if self.is_not_due and not self.allow_early:
-            return 0
-        today = date.today()
-        zero = self.duedate - self.decay_length
-        mult = max(0, (today - zero).days)
-        days_late = max(0, (today - self.duedate).days)
-        return self.points * (mult + days_late) # double count late days
+# The shards other than their own that have tasks shared with a user, when
+# the database is sharded (see sharding.py)
+shard_links = Table('shard_links', CyclenceBase.metadata,
+    Column('email', String, ForeignKey('users.email', ondelete='CASCADE'),
+           primary_key=True),
+    Column('shard', Integer, primary_key=True),
+)
 
+def other_shard(session, email):
+    r'''The shard the user `email` lives on, if the database is sharded and
+    it isn't the one `session` is on. Otherwise None.'''
+    router = getattr(session, 'router', None)
+    if router is None:
+        return None
+    shard = router.shard_of(email)
+    return shard if shard != session.shard else None
+
+def copy_friendship(session, friends):
+    r'''Stores the friendship between `friends`, a list of (email, name), on
+    the shard of `session`, copying the users there if they are missing'''
+    (email_1, name_1), (email_2, name_2) = friends
+    User.ghost(session, email_1, name_1)
+    User.ghost(session, email_2, name_2)
+    session.flush()
+    exists = session.execute(select([friendships.c.email_1]).where(and_(
+        friendships.c.email_1 == email_1,
+        friendships.c.email_2 == email_2))).first()
+    if exists is None:
+        session.execute(friendships.insert().values(email_1=email_1,
+                                                    email_2=email_2))
+
+# kinds of entity in the change log
+TASK_ENTITY = 'task'
+NOTIFICATION_ENTITY = 'notification'
+FRIEND_ENTITY = 'friend'
+
+# Filled in by triggers (see migrations.py) whenever something a user can
+# see changes, so clients can sync just what changed. `txid` is the
+# transaction that made the change.
+changes = Table('changes', CyclenceBase.metadata,
+    Column('version', BigInteger, primary_key=True),
+    Column('txid', BigInteger, nullable=False,
+           server_default=text('txid_current()')),
+    Column('email', String, nullable=False),
+    Column('entity', String, nullable=False),
+    Column('entity_id', String, nullable=False),
+    Column('changed_on', DateTime, nullable=False, server_default=func.now()),
+    Index('ix_changes_email_txid_version', 'email', 'txid', 'version'),
+    # for purging the oldest changes
+    Index('ix_changes_txid', 'txid'),
+)
 
-friendships = Table('friendships', CyclenceBase.metadata,
-    Column('email_1', String, ForeignKey('users.email'), primary_key=True),
-    Column('email_2', String, ForeignKey('users.email'), primary_key=True)
+# The newest transaction whose changes have been purged from `changes`, one
+# row per purge. Sync cursors from before the newest have missed changes.
+purged_changes = Table('purged_changes', CyclenceBase.metadata,
+    Column('txid', BigInteger, primary_key=True),
+    Column('purged_on', DateTime, nullable=False, server_default=func.now()),
 )
 
 class User(CyclenceBase):
@@ -292,18 +525,69 @@ class User(CyclenceBase):
     _followers = relationship('User', secondary=friendships,
                               primaryjoin=friendships.c.email_1==email,
                               secondaryjoin=friendships.c.email_2==email,
-                              backref='_followees')
+                              passive_deletes=True,
+                              backref=backref('_followees',
+                                              passive_deletes=True))
 
     notifications = relationship(Notification, order_by=Notification.timestamp.desc(),
                                  backref='user',
                                  primaryjoin='User.email == Notification.email',
-                                 cascade='all, delete, delete-orphan')
+                                 cascade='all, delete, delete-orphan',
+                                 passive_deletes=True)
+    @classmethod
+    def ghost(cls, session, email, name):
+        r'''The user `email` in `session`. If they aren't on its shard, a copy
+        of them with just their email and name is added.'''
+        user = session.query(cls).get(email)
+        if user is None:
+            user = cls(email=email, name=name)
+            session.add(user)
+        return user
+
     @property
     def total_points(self):
         r'''Returns the total number of points earned by this user'''
         return object_session(self).query(func.sum(Completion.points_earned))\
                                               .filter_by(email=self.email).one()[0]
 
+    def tasks_query(self):
+        r'''A query over this user's tasks, for filtering in the database
+        rather than loading the `tasks` collection'''
+        return object_session(self).query(Task).join(usertasks)\
+                                   .filter(usertasks.c.email == self.email)
+
+    def next_tasks(self, limit):
+        r'''Query for the `limit` tasks this user should do next, in order'''
+        return self.tasks_query().filter(Task.sort_value > 0)\
+                                 .order_by(Task.sort_value.desc())\
+                                 .limit(limit)
+
+    def tasks_tagged(self, tag_name):
+        r'''Query for this user's tasks that have the tag `tag_name`'''
+        return self.tasks_query().join(Tag).filter(Tag.tag_name == tag_name)
+
+    def search_tasks(self, terms):
+        r'''Query for this user's tasks whose name or notes match `terms`'''
+        english = text("'english'")
+        return self.tasks_query().filter(
+            search_vector(Task.name, Task.notes)
+            .op('@@')(func.plainto_tsquery(english, terms)))
+
+    def tag_counts_query(self):
+        r'''A query of (tag_name, count) for all tags on this user's tasks,
+        most used first'''
+        count = func.count(Tag.task_id)
+        return object_session(self).query(Tag.tag_name, count)\
+                   .join(usertasks, usertasks.c.task_id == Tag.task_id)\
+                   .filter(usertasks.c.email == self.email)\
+                   .group_by(Tag.tag_name)\
+                   .order_by(count.desc(), Tag.tag_name)
+
+    def tag_counts(self):
+        r'''Returns a list of (tag_name, count) for all tags on this user's
+        tasks, most used first'''
+        return self.tag_counts_query().all()
+
     def share_task(self, task, sharer):
         r'''Share a task with this user'''
         self.notify('share', '{.name} has shared the task "{.name}" with you'
@@ -315,14 +599,22 @@ class User(CyclenceBase):
                     sender=sender.email)
 
     def notify(self, noti_type, msg, task_id=None, sender=None):
-        self.notifications.append(Notification(notification_id=str(uuid4()),
-                                               email=self.email,
-                                               timestamp=datetime.now(),
-                                               message=msg,
-                                               noti_type=noti_type,
-                                               task_id=task_id,
-                                               sender=sender,
-                                               ))
+        Notification.send(object_session(self), [self.email], noti_type, msg,
+                          task_id=task_id, sender=sender)
+
+    def add_friend(self, friend):
+        r'''Makes this user and `friend` friends'''
+        self._followers.append(friend)
+        session = object_session(self)
+        if session is not None:
+            for email in (self.email, friend.email):
+                events.publish(session, email, events.FRIENDS,
+                               friends=[self.email, friend.email])
+            shard = other_shard(session, friend.email)
+            if shard is not None:
+                session.defer(shard, partial(
+                    copy_friendship, friends=[(self.email, self.name),
+                                              (friend.email, friend.name)]))
 
     @property
     def friends(self):
@@ -331,7 +623,7 @@ class User(CyclenceBase):
     @property
     def gravatar_url(self):
         return 'http://www.gravatar.com/avatar/{hash}'.format(
-            hash = md5(self.email).hexdigest())
+            hash = utils.gravatar_hash(self.email))
 
 class AlreadyCompletedException(Exception):
     '''Thrown when a task is completed on a date it has already been completed
@@ -0,0 +1,93 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''A user's completions per day over the last year, for a heatmap.
+
+The completions are totalled per day by the database, so at most a row per
+day comes back from each shard however many completions a user has, and the
+rolling on time rate is worked out from those with numpy.'''
+
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import select, func, case
+
+from cyclence.Calendaring import Completion
+
+DAYS = 365
+WINDOW = 30 # days the on time rate is averaged over
+
+def aggregate(rows, days=DAYS, window=WINDOW):
+    r'''Totals `rows` of (day offset, completions, points earned, completions
+    on time), where offset 0 is `window` - 1 days before the first day
+    reported. A day may have several rows, one from each shard. Returns the
+    completions, points and on time rate for each of the `days` days. The
+    rate is over the `window` days ending that day, and NaN if nothing was
+    completed in them.'''
+    size = days + window - 1
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 4)
+    offsets = rows[:, 0]
+    completions, earned, on_time = [
+        np.bincount(offsets, weights=rows[:, i], minlength=size)
+        for i in (1, 2, 3)]
+    completions = completions.astype(np.int64)
+
+    def rolling(per_day):
+        totals = np.concatenate(([0], np.cumsum(per_day)))
+        return totals[window:] - totals[:-window]
+
+    completed_in_window = rolling(completions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = rolling(on_time) / completed_in_window.astype(float)
+    rate[completed_in_window == 0] = np.nan
+    return (completions[window - 1:], earned[window - 1:].astype(np.int64),
+            rate)
+
+def days_query(email, first, end):
+    r'''The completions of `email` from `first` to `end` totalled per day, as
+    (day offset from `first`, completions, points earned, completions on
+    time)'''
+    on_time = case([(func.coalesce(Completion.days_late, 0) <= 0, 1)],
+                   else_=0)
+    return select([Completion.completed_on - first,
+                   func.count(),
+                   func.coalesce(func.sum(Completion.points_earned), 0),
+                   func.sum(on_time)])\
+        .where(Completion.email == email)\
+        .where(Completion.completed_on.between(first, end))\
+        .group_by(Completion.completed_on)
+
+def activity(sessions, email, end=None, days=DAYS, window=WINDOW):
+    r'''The activity of the user `email` for the `days` days up to `end`, from
+    their completions in each of `sessions`, as a JSON serializable dict'''
+    end = end or date.today()
+    start = end - timedelta(days - 1)
+    first = start - timedelta(window - 1)
+    rows = []
+    for session in sessions:
+        rows.extend(session.execute(
+            days_query(email, first, end)).fetchall())
+    completions, points, rate = aggregate(rows, days, window)
+    return dict(start=start.isoformat(),
+                end=end.isoformat(),
+                window=window,
+                completions=completions.tolist(),
+                points=points.tolist(),
+                on_time_rate=[None if np.isnan(r) else round(r, 3)
+                              for r in rate.tolist()],
+                total_completions=int(completions.sum()),
+                total_points=int(points.sum()))
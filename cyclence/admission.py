@@ -0,0 +1,128 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Admission control for a single worker.
+
+A worker handles one request at a time while it talks to the database, so
+under a burst requests wait unseen in its socket until the clients give up.
+Each request is checked before it's handled: if it has already waited longer
+than its queue time budget, or too many requests are in progress, it gets a
+quick 503 with a Retry-After header instead.
+
+Tornado only notes a request's start time once it gets round to reading it,
+after everything ahead of it has been handled. So `HTTPServer` notes when each
+connection was accepted, and a connection's first request is counted as
+waiting from then. Later requests on a kept alive connection can only be
+counted from when they are read. The listen backlog (CYCLENCE_LISTEN_BACKLOG)
+caps how many connections can wait to be accepted at all.
+
+Light requests get more of both, so they are still answered when heavy ones
+are being turned away.'''
+
+import time
+from collections import defaultdict
+
+from tornado import httpserver
+
+LIGHT = 'light'
+HEAVY = 'heavy'
+
+# reasons a request was shed
+QUEUE_TIME = 'queue time'
+IN_FLIGHT = 'in flight'
+
+class HTTPServer(httpserver.HTTPServer):
+    r'''Notes when each connection was accepted, for `arrived_at`'''
+
+    def handle_stream(self, stream, address):
+        stream.accepted_at = time.time()
+        httpserver.HTTPServer.handle_stream(self, stream, address)
+
+def arrived_at(request):
+    r'''When `request` arrived: when its connection was accepted, if it's the
+    first request on it, otherwise when tornado started reading it'''
+    stream = getattr(request.connection, 'stream', None)
+    accepted = getattr(stream, 'accepted_at', None)
+    if accepted is None:
+        return request._start_time
+    stream.accepted_at = None # only the first request waited since then
+    return min(accepted, request._start_time)
+
+class AdmissionControl(object):
+    r'''Decides whether to handle or shed requests, and counts both.
+
+    `max_in_flight` limits all requests in progress, and `max_heavy` limits
+    heavy ones. `queue_budget` is how long in seconds a heavy request can wait
+    before it's handled; light ones can wait `light_factor` times as long.
+    Zero means no limit. Synchronous handlers run one at a time, so only
+    asynchronous ones count towards the in flight limits for long; a burst
+    of synchronous requests is shed by the queue time budget.'''
+
+    def __init__(self, max_in_flight=0, max_heavy=0, queue_budget=0.0,
+                 light_factor=4, retry_after=2, clock=time.time):
+        self.limits = {LIGHT: max_in_flight, HEAVY: max_heavy or max_in_flight}
+        self.budgets = {LIGHT: queue_budget * light_factor,
+                        HEAVY: queue_budget}
+        self.retry_after = retry_after
+        self.clock = clock
+        self.in_flight = defaultdict(int)
+        self.peak_in_flight = 0
+        self.admitted = defaultdict(int)
+        self.shed = defaultdict(int) # (cost, reason) -> count
+        self.max_queue_time = 0.0
+
+    @property
+    def total_in_flight(self):
+        return sum(self.in_flight.values())
+
+    def admit(self, cost, request):
+        r'''Returns None if `request` may be handled, otherwise why it
+        should be shed. Admitted requests must be passed to `release`.'''
+        waited = self.clock() - arrived_at(request)
+        self.max_queue_time = max(self.max_queue_time, waited)
+        if self.budgets[cost] and waited > self.budgets[cost]:
+            reason = QUEUE_TIME
+        elif cost == HEAVY and self.limits[HEAVY] and \
+                self.in_flight[HEAVY] >= self.limits[HEAVY]:
+            reason = IN_FLIGHT
+        elif self.limits[LIGHT] and \
+                self.total_in_flight >= self.limits[LIGHT]:
+            reason = IN_FLIGHT
+        else:
+            self.in_flight[cost] += 1
+            self.admitted[cost] += 1
+            self.peak_in_flight = max(self.peak_in_flight,
+                                      self.total_in_flight)
+            return None
+        self.shed[cost, reason] += 1
+        return reason
+
+    def release(self, cost):
+        self.in_flight[cost] -= 1
+
+    def stats(self):
+        r'''The counters, for exporting'''
+        return dict(in_flight=dict(self.in_flight),
+                    peak_in_flight=self.peak_in_flight,
+                    admitted=dict(self.admitted),
+                    shed=dict((cost, dict((reason, count)
+                                          for (c, reason), count
+                                          in self.shed.items() if c == cost))
+                              for cost in (LIGHT, HEAVY)),
+                    max_queue_time=self.max_queue_time,
+                    limits=self.limits,
+                    budgets=self.budgets)
@@ -0,0 +1,66 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Simple in process caches'''
+
+import time
+from collections import OrderedDict
+
+class TTLCache(object):
+    r'''A per process cache whose entries expire `ttl` seconds after they are
+    set. When more than `max_size` entries are stored, the oldest are
+    dropped.'''
+
+    def __init__(self, ttl, max_size=10000, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return default
+        if expires < self.clock():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def keys(self):
+        r'''The keys that haven't expired, oldest first'''
+        now = self.clock()
+        return [key for key, (expires, _) in self._entries.items()
+                if expires >= now]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
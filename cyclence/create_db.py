@@ -15,15 +15,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
 
-'''Creates the database from the model'''
-
-import os
+'''Creates the database, or every shard of it, from the model'''
 
 from sqlalchemy import create_engine
 
 from cyclence.Calendaring import CyclenceBase
+from cyclence.migrations import upgrade
+from cyclence.sharding import shard_urls
 
 
 if __name__ == '__main__':
-    engine = create_engine(os.getenv('CYCLENCE_DB_CONNECTION_STRING'), echo=True)
-    CyclenceBase.metadata.create_all(engine)
+    for url in shard_urls():
+        engine = create_engine(url, echo=True)
+        CyclenceBase.metadata.create_all(engine)
+        # records the schema version, so only newer migrations run later
+        upgrade(engine)
@@ -0,0 +1,89 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Per process cache of each user's task list for the day.
+
+Every task changes priority at midnight, which is also when every open page
+reloads. So shortly before midnight, tomorrow's task lists are computed for
+everyone who used this worker recently, a few at a time, and are waiting in
+the cache when the reloads arrive.'''
+
+import time
+from datetime import date, datetime, timedelta
+from datetime import time as dt_time
+from functools import partial
+
+from cyclence.cache import TTLCache
+from cyclence.views import dashboard
+
+class Dashboards(object):
+    r'''Task lists keyed by (email, day). `forget` must be called when one of
+    a user's tasks changes.'''
+
+    def __init__(self, sessions_for, io_loop, ttl=1200, lead=300,
+                 active_for=24 * 60 * 60):
+        # sessions_for(email) opens sessions on every database with their tasks
+        self.sessions_for = sessions_for
+        self.io_loop = io_loop
+        self.lead = lead # seconds before midnight to start the rollover
+        self.cache = TTLCache(ttl)
+        self.active = TTLCache(active_for)
+
+    def get(self, sessions, email):
+        r'''Today's task list for `email`, from their tasks in `sessions`'''
+        day = date.today()
+        self.active.set(email, True)
+        tasks = self.cache.get((email, day))
+        if tasks is None:
+            tasks = dashboard(sessions, email, day)
+            self.cache.set((email, day), tasks)
+        return tasks
+
+    def forget(self, email):
+        today = date.today()
+        for day in (today, today + timedelta(1)):
+            self.cache.invalidate((email, day))
+
+    def schedule_rollover(self):
+        r'''Arranges for the next rollover to run `lead` seconds before
+        midnight'''
+        now = datetime.now()
+        start = datetime.combine(now.date() + timedelta(1), dt_time()) \
+            - timedelta(seconds=self.lead)
+        if start <= now:
+            start += timedelta(1)
+        self.io_loop.add_timeout(time.time() + (start - now).total_seconds(),
+                                 self.rollover)
+
+    def rollover(self):
+        r'''Computes tomorrow's task lists for the recently active users,
+        spread over the first half of the time left before midnight'''
+        tomorrow = date.today() + timedelta(1)
+        emails = self.active.keys()
+        spacing = self.lead / 2.0 / max(1, len(emails))
+        for i, email in enumerate(emails):
+            self.io_loop.add_timeout(time.time() + i * spacing,
+                                     partial(self.warm, email, tomorrow))
+        self.schedule_rollover()
+
+    def warm(self, email, day):
+        sessions = self.sessions_for(email)
+        try:
+            self.cache.set((email, day), dashboard(sessions, email, day))
+        finally:
+            for session in sessions:
+                session.close()
@@ -0,0 +1,243 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''An append only log of completions, for analytics that shouldn't touch the
+database.
+
+Every committed completion, and every deletion that removes completions, is
+appended to a segment file as a fixed width binary record. Each process
+writes its own segments and starts a new one when the current one gets too
+big. Readers memory map the segments as numpy arrays, so replaying millions
+of records doesn't copy them, and work out which completions survive with
+whole array operations.
+
+Users are identified by a 64 bit hash of their email address (see
+`user_key`), so that records stay fixed width. Completions by nobody, such as
+those of deleted users, have the key 0.
+
+    python -m cyclence.eventlog /var/lib/cyclence/events
+'''
+
+from __future__ import print_function
+
+import os
+import mmap
+import glob
+import time
+import struct
+import weakref
+from uuid import UUID
+from datetime import date
+from collections import namedtuple, defaultdict
+
+import numpy as np
+from sqlalchemy import event
+
+from cyclence.Calendaring import Task, Completion, User
+from cyclence.utils import email_md5
+
+# kinds of record
+COMPLETED = 1 # a task was completed
+UNCOMPLETED = 2 # a completion was deleted
+TASK_DELETED = 3 # a task and all of its completions were deleted
+USER_DELETED = 4 # a user was deleted, their completions are kept anonymously
+
+# kind, task id, user key, date ordinal, points earned, days late
+RECORD = struct.Struct('<B3x16sQiii')
+# the same layout, for reading whole segments at once
+DTYPE = np.dtype([('kind', 'u1'), ('pad', 'V3'), ('task_id', 'V16'),
+                  ('user', '<u8'), ('day', '<i4'), ('points', '<i4'),
+                  ('days_late', '<i4')])
+assert DTYPE.itemsize == RECORD.size
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SUFFIX = '.events'
+
+Record = namedtuple('Record', 'kind task_id user day points days_late')
+
+def user_key(email):
+    r'''The 64 bit number that stands for `email` in the log'''
+    digest = email_md5(email).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+def pack(kind, task_id=None, email=None, day=None, points=0, days_late=0):
+    return RECORD.pack(kind,
+                       UUID(task_id).bytes if task_id else b'\0' * 16,
+                       user_key(email) if email else 0,
+                       day.toordinal() if day else 0,
+                       points or 0,
+                       days_late or 0)
+
+def completion_record(kind, completion):
+    return pack(kind, completion.task_id, completion.email,
+                completion.completed_on, completion.points_earned,
+                completion.days_late)
+
+
+class EventLog(object):
+    r'''Appends records to this process's current segment in `directory`'''
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment = None
+        self._pending = weakref.WeakKeyDictionary() # session -> records
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _open_segment(self):
+        # named so that sorting the names sorts segments by when they began
+        name = '{:017.6f}-{}{}'.format(time.time(), os.getpid(), SUFFIX)
+        self.segment = open(os.path.join(self.directory, name), 'ab')
+
+    def append(self, records):
+        r'''Writes packed `records` to the log'''
+        if not records:
+            return
+        if self.segment is None or self.segment.tell() >= self.segment_size:
+            self.close()
+            self._open_segment()
+        self.segment.write(b''.join(records))
+        self.segment.flush()
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def install(self, Session):
+        r'''Logs the completions committed by sessions from the sessionmaker
+        `Session`'''
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        records = self._pending.setdefault(session, [])
+        for obj in session.new:
+            if isinstance(obj, Completion):
+                records.append(completion_record(COMPLETED, obj))
+        for obj in session.deleted:
+            if isinstance(obj, Completion):
+                records.append(completion_record(UNCOMPLETED, obj))
+            elif isinstance(obj, Task):
+                records.append(pack(TASK_DELETED, obj.task_id,
+                                    day=date.today()))
+            elif isinstance(obj, User):
+                records.append(pack(USER_DELETED, email=obj.email,
+                                    day=date.today()))
+
+    def _after_commit(self, session):
+        self.append(self._pending.pop(session, []))
+
+    def _after_rollback(self, session):
+        self._pending.pop(session, None)
+
+
+def segments(directory):
+    r'''The segment files in `directory`, oldest first'''
+    return sorted(glob.glob(os.path.join(directory, '*' + SUFFIX)),
+                  key=os.path.basename)
+
+def load_segment(path):
+    r'''The records in the segment at `path` as an array of `DTYPE`, backed by
+    the file. A partly written record at the end is ignored.'''
+    with open(path, 'rb') as f:
+        count = os.fstat(f.fileno()).st_size // RECORD.size
+        if not count:
+            return np.zeros(0, DTYPE)
+        # the array keeps the map open for as long as it's used
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return np.frombuffer(data, DTYPE, count)
+
+def read_segment(path):
+    r'''Yields the records in the segment at `path`'''
+    for r in load_segment(path):
+        yield Record(int(r['kind']), str(UUID(bytes=r['task_id'].tobytes())),
+                     int(r['user']), int(r['day']), int(r['points']),
+                     int(r['days_late']))
+
+def replay(directory):
+    r'''Yields every record in the log'''
+    for path in segments(directory):
+        for record in read_segment(path):
+            yield record
+
+def load(directory):
+    r'''Every record in the log, as one array'''
+    arrays = [load_segment(path) for path in segments(directory)]
+    return np.concatenate(arrays) if arrays else np.zeros(0, DTYPE)
+
+def _last(groups, count, where):
+    r'''The position of the last record of each of the `count` groups among
+    the records `where` is true, or -1'''
+    last = np.full(count, -1, np.int64)
+    np.maximum.at(last, groups[where], np.flatnonzero(where))
+    return last
+
+def surviving(records):
+    r'''The COMPLETED `records` that nothing later in the log removed: not
+    completed again or uncompleted on the same day, and whose task wasn't
+    deleted afterwards. Those of users deleted afterwards are kept, with the
+    user key 0, as the database keeps them with no completer.'''
+    if not len(records):
+        return records
+    position = np.arange(len(records))
+    kind = records['kind']
+    tasks, task = np.unique(records['task_id'], return_inverse=True)
+    users, user = np.unique(records['user'], return_inverse=True)
+    days, day = np.unique(records['day'], return_inverse=True)
+    task_day = task.astype(np.int64) * len(days) + day
+    task_days, task_day = np.unique(task_day, return_inverse=True)
+    last_change = _last(task_day, len(task_days),
+                        (kind == COMPLETED) | (kind == UNCOMPLETED))
+    task_deleted = _last(task, len(tasks), kind == TASK_DELETED)
+    user_deleted = _last(user, len(users), kind == USER_DELETED)
+    keep = ((kind == COMPLETED) &
+            (last_change[task_day] == position) &
+            (task_deleted[task] < position))
+    kept = records[keep] # a copy
+    kept['user'][user_deleted[user[keep]] > position[keep]] = 0
+    return kept
+
+def completions(directory):
+    r'''The completions that still exist after replaying the log, as a dict
+    of task id -> {date ordinal: record}'''
+    tasks = defaultdict(dict)
+    for r in surviving(load(directory)):
+        record = Record(COMPLETED, str(UUID(bytes=r['task_id'].tobytes())),
+                        int(r['user']), int(r['day']), int(r['points']),
+                        int(r['days_late']))
+        tasks[record.task_id][record.day] = record
+    return tasks
+
+def points_by_user(directory):
+    r'''Total points earned by each user key, leaving out completions by
+    nobody'''
+    records = surviving(load(directory))
+    records = records[records['user'] != 0]
+    users, user = np.unique(records['user'], return_inverse=True)
+    totals = np.bincount(user, weights=records['points'],
+                         minlength=len(users))
+    return dict(zip(users.tolist(), totals.astype(np.int64).tolist()))
+
+
+if __name__ == '__main__':
+    import sys
+    totals = points_by_user(sys.argv[1])
+    for user, points in sorted(totals.items(), key=lambda x: -x[1]):
+        print('{:016x} {}'.format(user, points))
@@ -0,0 +1,197 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Live events for clients. Events are published with postgres NOTIFY, so
+they are only delivered if the transaction that published them commits, and
+every worker process LISTENing on the channel receives every event. With
+several databases, workers listen on all of them.'''
+
+from __future__ import print_function
+
+import json
+import logging
+import time
+from collections import defaultdict, deque
+
+from sqlalchemy import select, func
+
+CHANNEL = 'cyclence_events'
+
+NOTIFICATION = 'notification'
+TASK = 'task'
+FRIENDS = 'friends'
+PROFILE = 'profile'
+
+def publish(session, email, kind, **data):
+    r'''Publishes an event of type `kind` for the user `email`. The event is
+    sent when the session's transaction commits.'''
+    publish_many(session, [(email, kind, data)])
+
+def publish_many(session, events):
+    r'''Publishes a list of (email, kind, data) events in one statement'''
+    now = time.time()
+    payloads = []
+    for email, kind, data in events:
+        data = dict(data, email=email, kind=kind, ts=now)
+        payloads.append(func.pg_notify(CHANNEL, json.dumps(data)))
+    if payloads:
+        session.execute(select(payloads))
+
+
+class EventListener(object):
+    r'''LISTENs for events in a worker process and hands them out to
+    subscribers waiting on a user's events. Recent events are kept for
+    `backlog` seconds so that clients don't miss events published between
+    polls.
+
+    If a connection is lost it is reopened, waiting `retry` seconds at first
+    and twice as long after each failure, up to `max_retry`. Events published
+    in the meantime are missed, so the reconnect handlers are called once it
+    is listening again.'''
+
+    def __init__(self, engines, io_loop, backlog=60, retry=1, max_retry=60):
+        self.engines = engines
+        self.io_loop = io_loop
+        self.backlog = backlog
+        self.retry = retry
+        self.max_retry = max_retry
+        self.conns = {} # file descriptor -> (engine, connection)
+        self.recent = deque()
+        self.waiters = defaultdict(set)
+        self.handlers = []
+        self.reconnect_handlers = []
+        self.stopped = False
+
+    def start(self):
+        '''Opens a dedicated connection to each database and starts
+        listening'''
+        self.stopped = False
+        for engine in self.engines:
+            self._listen(engine)
+
+    def stop(self):
+        self.stopped = True
+        for fd, (_, conn) in list(self.conns.items()):
+            self._drop(fd, conn)
+
+    def add_handler(self, handler):
+        r'''Calls `handler(event)` for every event received, regardless of
+        whether any client is waiting for it'''
+        self.handlers.append(handler)
+
+    def add_reconnect_handler(self, handler):
+        r'''Calls `handler()` after a lost connection is listening again'''
+        self.reconnect_handlers.append(handler)
+
+    def _listen(self, engine, delay=None):
+        r'''Opens a connection to `engine` and LISTENs on it. Returns whether
+        it worked; if not, tries again after `delay` seconds.'''
+        from psycopg2 import OperationalError
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+        try:
+            raw = engine.raw_connection()
+            raw.detach() # this connection never goes back to the pool
+            conn = raw.connection
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute('LISTEN ' + CHANNEL)
+        except OperationalError as e:
+            delay = self.retry if delay is None else delay
+            print('Could not LISTEN for events, retrying in {}s: {}'
+                  .format(delay, e))
+            self.io_loop.add_timeout(
+                time.time() + delay,
+                lambda: self._reconnect(engine, min(delay * 2,
+                                                    self.max_retry)))
+            return False
+        self.conns[conn.fileno()] = (engine, conn)
+        self.io_loop.add_handler(conn.fileno(), self._on_readable,
+                                 self.io_loop.READ)
+        return True
+
+    def _reconnect(self, engine, delay=None):
+        if self.stopped:
+            return
+        if self._listen(engine, delay):
+            for handler in self.reconnect_handlers:
+                handler()
+
+    def _drop(self, fd, conn):
+        self.io_loop.remove_handler(fd)
+        del self.conns[fd]
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _on_readable(self, fd, events):
+        from psycopg2 import OperationalError
+        engine, conn = self.conns[fd]
+        try:
+            conn.poll()
+        except OperationalError as e:
+            print('Lost the events connection: {}'.format(e))
+            self._drop(fd, conn)
+            self._reconnect(engine)
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                event = json.loads(notify.payload)
+            except ValueError:
+                print('Bad event payload: {!r}'.format(notify.payload))
+                continue
+            self.dispatch(event)
+
+    def dispatch(self, event):
+        r'''Hands `event` to every handler and every waiter on its user. One
+        of them failing doesn't keep it from the rest.'''
+        self.recent.append(event)
+        self._expire()
+        for handler in self.handlers:
+            try:
+                handler(event)
+            except Exception:
+                logging.exception('Event handler failed on %r', event)
+        for callback in list(self.waiters.pop(event['email'], ())):
+            try:
+                callback([event])
+            except Exception:
+                logging.exception('Event waiter failed on %r', event)
+
+    def _expire(self):
+        cutoff = time.time() - self.backlog
+        while self.recent and self.recent[0]['ts'] < cutoff:
+            self.recent.popleft()
+
+    def subscribe(self, email, since, callback):
+        r'''Calls `callback` with a list of events for `email` newer than
+        `since`. If there are already some it is called immediately,
+        otherwise it waits for the next event.'''
+        self._expire()
+        missed = [e for e in self.recent
+                  if e['email'] == email and e['ts'] > since]
+        if missed:
+            callback(missed)
+        else:
+            self.waiters[email].add(callback)
+
+    def unsubscribe(self, email, callback):
+        waiting = self.waiters.get(email)
+        if waiting is not None:
+            waiting.discard(callback)
+            if not waiting:
+                del self.waiters[email]
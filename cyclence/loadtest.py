@@ -0,0 +1,245 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''An end to end load test for the website.
+
+Seeds a scratch database, starts some workers against it and has simulated
+users look at their tasks, complete them, share them and accept shares. Users
+are logged in by minting signed cookies with the workers' cookie secret, so
+Google is never involved. Reports throughput and latency per endpoint.
+
+    CYCLENCE_TEST_DB_CONNECTION_STRING=... python -m cyclence.loadtest \\
+        --seed --workers=4 --users=200 --concurrency=50 --duration=60
+
+The workers use the database in CYCLENCE_TEST_DB_CONNECTION_STRING, never the
+one in CYCLENCE_DB_CONNECTION_STRING. Seeding skips users that are already
+there, so --seed can be given on every run.
+
+Extra environment variables (like CYCLENCE_DB_POOL_SIZE) are passed through to
+the workers, so runs with different settings can be compared.
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import random
+import socket
+import subprocess
+from base64 import b64encode
+from collections import defaultdict
+from datetime import date
+
+from tornado import gen, ioloop, web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from sqlalchemy import create_engine, select
+
+from cyclence import queryplans
+from cyclence.Calendaring import User, usertasks
+from cyclence.website.main import user_cookie
+
+ACCEPT_REGEX = re.compile(r'action="/notifications/([\da-f-]{36})"\s*'
+                          r'method="post">\s*'
+                          r'<input type="hidden" name="accept"')
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+class Stats(object):
+    r'''Latencies and errors per endpoint'''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, ok):
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, elapsed, out=sys.stdout):
+        fmt = '{:<40} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}'
+        print(fmt.format('endpoint', 'count', 'errors', 'req/s',
+                         'p50 ms', 'p90 ms', 'p99 ms', 'max ms'), file=out)
+        for endpoint in sorted(self.latencies):
+            ordered = sorted(self.latencies[endpoint])
+            print(fmt.format(endpoint,
+                             len(ordered),
+                             self.errors[endpoint],
+                             '{:.1f}'.format(len(ordered) / elapsed),
+                             *['{:.1f}'.format(1000 * x) for x in
+                               [percentile(ordered, 50),
+                                percentile(ordered, 90),
+                                percentile(ordered, 99),
+                                ordered[-1]]]), file=out)
+
+
+class LoadTest(object):
+    r'''Drives `concurrency` simulated users against `urls` for `duration`
+    seconds'''
+
+    def __init__(self, urls, cookie_secret, accounts, concurrency, duration):
+        self.urls = urls
+        self.cookie_secret = cookie_secret
+        self.accounts = accounts # list of (email, name, task_ids, friends)
+        self.concurrency = concurrency
+        self.duration = duration
+        self.stats = Stats()
+        self.client = AsyncHTTPClient(max_clients=concurrency)
+
+    def cookie(self, email, name):
+        value = web.create_signed_value(self.cookie_secret, 'user',
+                                        user_cookie(User(email=email,
+                                                         name=name)))
+        return 'user=' + value.decode('ascii') if isinstance(value, bytes) \
+            else 'user=' + value
+
+    @gen.coroutine
+    def request(self, endpoint, cookie, path, method='GET', body=None):
+        r'''Makes a request, recording its latency under `endpoint`'''
+        url = random.choice(self.urls) + path
+        req = HTTPRequest(url, method=method, body=body,
+                          headers={'Cookie': cookie},
+                          follow_redirects=False)
+        start = time.time()
+        try:
+            response = yield self.client.fetch(req)
+        except HTTPError as e:
+            # redirects after a POST are how this site says "done"
+            response = e.response
+            ok = e.code in (301, 302, 303)
+        else:
+            ok = True
+        self.stats.record(endpoint, time.time() - start, ok)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def simulate(self, deadline):
+        r'''One user clicking around until `deadline`'''
+        while time.time() < deadline:
+            email, name, task_ids, friends = random.choice(self.accounts)
+            cookie = self.cookie(email, name)
+            flow = random.random()
+            if flow < 0.5 or not task_ids:
+                yield self.request('GET /tasks', cookie, '/tasks')
+            elif flow < 0.75:
+                yield self.request(
+                    'POST /tasks/:id/completions/:date', cookie,
+                    '/tasks/{}/completions/{}'.format(
+                        random.choice(task_ids), date.today().isoformat()),
+                    method='POST', body='')
+            elif flow < 0.85 and friends:
+                yield self.request(
+                    'POST /tasks/:id/share', cookie,
+                    '/tasks/{}/share'.format(random.choice(task_ids)),
+                    method='POST',
+                    body='friend=' + random.choice(friends))
+            else:
+                response = yield self.request('GET /notifications', cookie,
+                                              '/notifications')
+                pending = ACCEPT_REGEX.findall(response.body.decode('utf-8')
+                                               if response and response.body
+                                               else '')
+                if pending:
+                    yield self.request(
+                        'POST /notifications/:id', cookie,
+                        '/notifications/{}'.format(random.choice(pending)),
+                        method='POST', body='accept=true')
+
+    @gen.coroutine
+    def run(self):
+        start = time.time()
+        yield [self.simulate(start + self.duration)
+               for _ in range(self.concurrency)]
+        raise gen.Return(time.time() - start)
+
+
+def load_accounts(engine, users):
+    r'''Returns (email, name, task_ids, friend emails) for the seeded
+    users'''
+    emails = queryplans.emails(users)
+    tasks = defaultdict(list)
+    for task_id, email in engine.execute(
+            select([usertasks.c.task_id, usertasks.c.email])):
+        tasks[email].append(task_id)
+    accounts = []
+    for i, email in enumerate(emails):
+        # seeded friendships link each user to the next few users
+        friends = [emails[(i + 1) % users], emails[(i - 1) % users]]
+        accounts.append((email, email.split('@')[0], tasks[email], friends))
+    return accounts
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Worker on port {} never started'.format(port))
+
+def start_workers(count, base_port, cookie_secret, connection_string):
+    env = dict(os.environ,
+               CYCLENCE_DB_CONNECTION_STRING=connection_string,
+               CYCLENCE_TORNADO_PORT=str(base_port),
+               CYCLENCE_COOKIE_SECRET=cookie_secret,
+               CYCLENCE_DEBUG='false')
+    env.pop('CYCLENCE_DB_SHARDS', None)
+    workers = [subprocess.Popen([sys.executable, '-m', 'cyclence.website.main',
+                                 '--worker_id={}'.format(i)], env=env)
+               for i in range(count)]
+    for i in range(count):
+        wait_for_port(base_port + i)
+    return workers
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options
+    define('workers', default=4, help='number of workers to start')
+    define('port', default=9800, help='port of the first worker')
+    define('users', default=200, help='number of users to seed')
+    define('concurrency', default=50, help='simultaneous simulated users')
+    define('duration', default=60, help='seconds to run for')
+    define('seed', default=False, help='seed the database first')
+    options.parse_command_line()
+
+    url = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+    if not url:
+        raise SystemExit('CYCLENCE_TEST_DB_CONNECTION_STRING must name a '
+                         'scratch database')
+    engine = create_engine(url)
+    if options.seed:
+        queryplans.seed(engine, users=options.users)
+    secret = b64encode(os.urandom(32)).decode('ascii')
+    workers = start_workers(options.workers, options.port, secret, url)
+    try:
+        test = LoadTest(['http://127.0.0.1:{}'.format(options.port + i)
+                         for i in range(options.workers)],
+                        secret,
+                        load_accounts(engine, options.users),
+                        options.concurrency,
+                        options.duration)
+        elapsed = ioloop.IOLoop.instance().run_sync(test.run)
+        test.stats.report(elapsed)
+    finally:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,231 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Schema migrations for existing databases.
+
+Migrations run in order and each one is recorded in the `schema_version`
+table. A new database is created from the model and then has every migration
+applied, so migrations must be safe to run against a schema that already has
+their changes. Each migration spells out its own DDL instead of reading the
+model, so that it does the same thing however the model changes later.'''
+
+from __future__ import print_function
+
+from datetime import datetime
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, Integer,
+                        String, DateTime, select, func)
+
+schema_version = Table('schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String),
+    Column('applied_on', DateTime),
+)
+
+MIGRATIONS = []
+
+def migration(description):
+    r'''Registers the decorated function as the next migration. It is called
+    with a connection inside a transaction.'''
+    def register(fn):
+        MIGRATIONS.append((len(MIGRATIONS) + 1, description, fn))
+        return fn
+    return register
+
+def create_index(conn, name, definition):
+    r'''Creates the index `name` as `definition`, e.g. "ON t (col)", unless it
+    exists'''
+    if conn.execute('SELECT 1 FROM pg_indexes WHERE indexname = %(name)s',
+                    name=name).first() is None:
+        print('Creating index {}'.format(name))
+        conn.execute('CREATE INDEX {} {}'.format(name, definition))
+
+def foreign_key(conn, table, column):
+    r'''The name and pg_constraint.confdeltype of the foreign key on
+    `table`.`column`, or (None, None)'''
+    row = conn.execute(
+        'SELECT c.conname, c.confdeltype FROM pg_constraint c '
+        'JOIN pg_attribute a '
+        '  ON a.attrelid = c.conrelid AND a.attnum = ANY (c.conkey) '
+        "WHERE c.conrelid = %(table)s::regclass AND c.contype = 'f' "
+        '  AND a.attname = %(column)s', table=table, column=column).first()
+    return tuple(row) if row is not None else (None, None)
+
+# pg_constraint.confdeltype for each ON DELETE action
+ON_DELETE_CODES = {'NO ACTION': 'a', 'RESTRICT': 'r', 'CASCADE': 'c',
+                   'SET NULL': 'n', 'SET DEFAULT': 'd'}
+
+def on_delete(conn, table, column, references, action):
+    r'''Makes `table`.`column` a foreign key of `references`, e.g.
+    "users (email)", that does `action` on delete, recreating it if it does
+    something else'''
+    name, code = foreign_key(conn, table, column)
+    if code == ON_DELETE_CODES[action]:
+        return
+    if name is not None:
+        conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name))
+    name = name or '{}_{}_fkey'.format(table, column)
+    print('Recreating foreign key {}'.format(name))
+    conn.execute('ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) '
+                 'REFERENCES {} ON DELETE {}'.format(table, name, column,
+                                                     references, action))
+
+def drop_foreign_key(conn, table, column):
+    r'''Drops the foreign key on `table`.`column`, if there is one'''
+    name, _ = foreign_key(conn, table, column)
+    if name is not None:
+        print('Dropping foreign key {}'.format(name))
+        conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name))
+
+def current_version(conn):
+    return conn.execute(select([func.max(schema_version.c.version)]))\
+               .scalar() or 0
+
+def upgrade(engine):
+    r'''Applies all migrations newer than the database's version, each in its
+    own transaction. Returns the migrations that were applied.'''
+    schema_version.create(engine, checkfirst=True)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        with engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            print('Migration {}: {}'.format(version, description))
+            fn(conn)
+            conn.execute(schema_version.insert(),
+                         version=version,
+                         description=description,
+                         applied_on=datetime.now())
+            applied.append((version, description))
+    return applied
+
+
+@migration('Indexes for tag filtering and task search')
+def tag_and_search_indexes(conn):
+    create_index(conn, 'ix_tasktags_tag_name', 'ON tasktags (tag_name)')
+    create_index(conn, 'ix_tasks_search',
+                 "ON tasks USING gin ("
+                 "(to_tsvector('english', coalesce(name, '')) || "
+                 "to_tsvector('english', coalesce(notes, ''))))")
+
+@migration('Indexes for task lists, notifications, friends and completions')
+def hot_query_indexes(conn):
+    create_index(conn, 'ix_taskuser_email', 'ON taskuser (email)')
+    create_index(conn, 'ix_notifications_email_timestamp',
+                 'ON notifications (email, timestamp)')
+    create_index(conn, 'ix_friendships_email_2', 'ON friendships (email_2)')
+    create_index(conn, 'ix_completions_email', 'ON completions (email)')
+    create_index(conn, 'ix_completions_task_id_completed_on',
+                 'ON completions (task_id, completed_on DESC)')
+
+@migration('Cascade deletes of tasks and users in the database')
+def cascading_deletes(conn):
+    for table, column, references, action in [
+            ('notifications', 'email', 'users (email)', 'CASCADE'),
+            ('notifications', 'sender', 'users (email)', 'SET NULL'),
+            ('notifications', 'task_id', 'tasks (task_id)', 'CASCADE'),
+            ('tasktags', 'task_id', 'tasks (task_id)', 'CASCADE'),
+            ('completions', 'task_id', 'tasks (task_id)', 'CASCADE'),
+            ('completions', 'email', 'users (email)', 'CASCADE'),
+            ('taskuser', 'task_id', 'tasks (task_id)', 'CASCADE'),
+            ('taskuser', 'email', 'users (email)', 'CASCADE'),
+            ('friendships', 'email_1', 'users (email)', 'CASCADE'),
+            ('friendships', 'email_2', 'users (email)', 'CASCADE')]:
+        on_delete(conn, table, column, references, action)
+
+
+CHANGE_TRIGGERS = [
+    ('cyclence_task_changed', ['tasks', 'tasktags', 'completions'], '''
+    INSERT INTO changes (email, entity, entity_id)
+    SELECT email, 'task', r.task_id::text FROM taskuser
+    WHERE task_id = r.task_id;'''),
+    ('cyclence_sharers_changed', ['taskuser'], '''
+    INSERT INTO changes (email, entity, entity_id)
+    SELECT email, 'task', r.task_id::text FROM taskuser
+    WHERE task_id = r.task_id AND email <> r.email
+    UNION ALL SELECT r.email, 'task', r.task_id::text;'''),
+    ('cyclence_notification_changed', ['notifications'], '''
+    INSERT INTO changes (email, entity, entity_id)
+    VALUES (r.email, 'notification', r.notification_id::text);'''),
+    ('cyclence_friendship_changed', ['friendships'], '''
+    INSERT INTO changes (email, entity, entity_id)
+    VALUES (r.email_1, 'friend', r.email_2), (r.email_2, 'friend', r.email_1);'''),
+]
+
+def ensure_change_triggers(conn):
+    r'''Creates or replaces the triggers that fill in the change log. These
+    are the triggers of migration 4, changing them needs a new migration.'''
+    for function, tables, body in CHANGE_TRIGGERS:
+        conn.execute('''
+CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;{}
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql'''.format(function, body))
+        for name in tables:
+            conn.execute('DROP TRIGGER IF EXISTS {0}_changes ON {0}'
+                         .format(name))
+            conn.execute('CREATE TRIGGER {0}_changes '
+                         'AFTER INSERT OR UPDATE OR DELETE ON {0} '
+                         'FOR EACH ROW EXECUTE PROCEDURE {1}()'
+                         .format(name, function))
+
+@migration('Change log for syncing clients')
+def change_log(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS changes (
+    version BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    email VARCHAR NOT NULL,
+    entity VARCHAR NOT NULL,
+    entity_id VARCHAR NOT NULL,
+    changed_on TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now())''')
+    create_index(conn, 'ix_changes_email_txid_version',
+                 'ON changes (email, txid, version)')
+    ensure_change_triggers(conn)
+
+@migration('Shard links, and notifications of tasks on other shards')
+def sharding(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS shard_links (
+    email VARCHAR REFERENCES users (email) ON DELETE CASCADE,
+    shard INTEGER,
+    PRIMARY KEY (email, shard))''')
+    drop_foreign_key(conn, 'notifications', 'task_id')
+
+@migration('Keep completions when the user who made them is deleted')
+def keep_completions(conn):
+    conn.execute('ALTER TABLE completions ALTER COLUMN email DROP NOT NULL')
+    on_delete(conn, 'completions', 'email', 'users (email)', 'SET NULL')
+
+@migration('Index for finding the oldest change')
+def oldest_change_index(conn):
+    create_index(conn, 'ix_changes_txid', 'ON changes (txid)')
+
+@migration('Watermark of purged sync changes')
+def purged_changes(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS purged_changes (
+    txid BIGINT PRIMARY KEY,
+    purged_on TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now())''')
+
+
+if __name__ == '__main__':
+    from cyclence.sharding import shard_urls
+    for url in shard_urls():
+        if not upgrade(create_engine(url)):
+            print('Already up to date')
@@ -0,0 +1,147 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Profiles a sample of live requests.
+
+Each profiled request leaves two files in the profile directory: a `.pstats`
+dump from cProfile, and a `.collapsed` file of sampled stacks that
+flamegraph.pl can draw. Only the newest profiles are kept.
+
+The stacks are only sampled while the process is using CPU time, so time
+spent waiting on the database doesn't show in the flamegraph. It does show
+in the `.pstats` dump, which is timed by the wall clock. Python only runs
+signal handlers between bytecodes, so a wall clock timer wouldn't sample
+those waits either, only interrupt them.
+
+Requests carrying a signed X-Cyclence-Profile header are always profiled. To
+make a header value with the site's cookie secret:
+
+    CYCLENCE_COOKIE_SECRET=... python -m cyclence.profiling
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import glob
+import time
+import random
+import signal
+import cProfile
+from collections import defaultdict
+
+from tornado import web
+
+HEADER = 'X-Cyclence-Profile'
+
+def profile_token(secret):
+    r'''A value for the profile header, valid for a day'''
+    return web.create_signed_value(secret, 'profile', 'admin')
+
+class StackSampler(object):
+    r'''Counts the stacks of the main thread every `interval` seconds of CPU
+    time. Time spent blocked, e.g. on the database, isn't sampled.'''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        r'''The samples in the "collapsed stack" format flamegraphs use'''
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+class Profiler(object):
+    r'''Decides which requests to profile and writes out the results. Does
+    nothing unless given a `directory` to write to.'''
+
+    def __init__(self, directory=None, rate=0.0, keep=100, secret=None):
+        self.directory = directory
+        self.rate = rate
+        self.keep = keep
+        self.secret = secret
+        self.running = False
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def wanted(self, request):
+        r'''Whether `request` should be profiled'''
+        if not self.directory or self.running:
+            return False
+        token = request.headers.get(HEADER)
+        if token and self.secret:
+            return web.decode_signed_value(self.secret, 'profile', token,
+                                           max_age_days=1) is not None
+        return self.rate > 0 and random.random() < self.rate
+
+    def start(self):
+        self.running = True
+        profile = cProfile.Profile()
+        sampler = StackSampler()
+        sampler.start()
+        profile.enable()
+        return profile, sampler
+
+    def finish(self, run, request, status):
+        profile, sampler = run
+        profile.disable()
+        sampler.stop()
+        self.running = False
+        name = '{:.3f}-{}-{}-{}'.format(time.time(), request.method,
+                                        re.sub(r'[^\w]+', '_', request.path)
+                                          .strip('_') or 'root',
+                                        status)
+        base = os.path.join(self.directory, name)
+        profile.dump_stats(base + '.pstats')
+        with open(base + '.collapsed', 'w') as f:
+            f.write(sampler.collapsed())
+        self.rotate()
+
+    def rotate(self):
+        r'''Deletes all but the newest `keep` profiles'''
+        dumps = sorted(glob.glob(os.path.join(self.directory, '*.pstats')),
+                       key=os.path.getmtime)
+        for old in dumps[:-self.keep]:
+            for path in (old, old[:-len('.pstats')] + '.collapsed'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+if __name__ == '__main__':
+    print('{}: {}'.format(HEADER,
+                          profile_token(os.getenv('CYCLENCE_COOKIE_SECRET'))))
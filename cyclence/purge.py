@@ -0,0 +1,157 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Bulk deletes of old or unwanted data.
+
+Rows are deleted in batches, each in its own transaction, so no lock is held
+for long and nothing is loaded into python. Whatever hangs off a deleted task
+or user is removed by the database's ON DELETE CASCADE. If
+CYCLENCE_EVENT_LOG_DIR is set, deleted tasks and users are recorded in the
+completion event log.
+
+    python -m cyclence.purge notifications --days=90
+    python -m cyclence.purge changes --days=30
+    python -m cyclence.purge tasks
+    python -m cyclence.purge users someone@example.com ...
+'''
+
+from __future__ import print_function
+
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, select, exists, func
+from sqlalchemy.sql import and_
+
+from cyclence import eventlog
+from cyclence.Calendaring import (User, Task, Notification, usertasks,
+                                  changes, purged_changes)
+from cyclence.sharding import shard_urls
+
+BATCH_SIZE = 1000
+
+def delete_in_batches(engine, key, where, batch=BATCH_SIZE, on_delete=None):
+    r'''Deletes the rows matching `where` from the table of the primary key
+    column `key`, `batch` at a time. Returns the number deleted. If given,
+    `on_delete` is called with the keys of each batch after it commits.'''
+    table = key.table
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            keys = [row[0] for row in conn.execute(
+                table.delete().where(key.in_(
+                    select([key]).where(where).limit(batch)))
+                .returning(key))]
+        if on_delete is not None:
+            on_delete(keys)
+        total += len(keys)
+        if len(keys) < batch:
+            return total
+
+def _log_tasks(log):
+    if log is None:
+        return None
+    return lambda task_ids: log.append(
+        [eventlog.pack(eventlog.TASK_DELETED, task_id, day=date.today())
+         for task_id in task_ids])
+
+def purge_notifications(engine, days, batch=BATCH_SIZE):
+    r'''Deletes notifications older than `days`'''
+    cutoff = datetime.now() - timedelta(days)
+    return delete_in_batches(engine, Notification.notification_id,
+                             Notification.timestamp < cutoff, batch)
+
+def purge_changes(engine, days, batch=BATCH_SIZE):
+    r'''Deletes the sync change log up to the newest transaction that made a
+    change more than `days` ago. Clients that last synced before then will get
+    everything again.'''
+    cutoff = datetime.now() - timedelta(days)
+    with engine.begin() as conn:
+        txid = conn.execute(select([func.max(changes.c.txid)])
+                            .where(changes.c.changed_on < cutoff)).scalar()
+        watermark = conn.execute(
+            select([func.max(purged_changes.c.txid)])).scalar()
+        # recorded before anything is deleted, so no sync can miss it
+        if txid is not None and (watermark is None or txid > watermark):
+            conn.execute(purged_changes.insert(), txid=txid)
+    if txid is None:
+        return 0
+    return delete_in_batches(engine, changes.c.version,
+                             changes.c.txid <= txid, batch)
+
+def purge_orphaned_tasks(engine, batch=BATCH_SIZE, log=None):
+    r'''Deletes tasks nobody has anymore, with their tags, completions and
+    notifications'''
+    return delete_in_batches(
+        engine, Task.task_id,
+        ~exists().where(usertasks.c.task_id == Task.task_id), batch,
+        _log_tasks(log))
+
+def purge_users(engine, emails, batch=BATCH_SIZE, log=None):
+    r'''Deletes the accounts of `emails`, and any tasks only they had. Their
+    notifications and tasks go first in batches, so the cascade from deleting
+    each user is small. Their completions of tasks others still share are
+    kept, without the completer.'''
+    total = 0
+    for email in emails:
+        delete_in_batches(engine, Notification.notification_id,
+                          Notification.email == email, batch)
+        # tasks only they have take their completions and tags with them
+        delete_in_batches(
+            engine, Task.task_id,
+            and_(exists().where(and_(usertasks.c.task_id == Task.task_id,
+                                     usertasks.c.email == email)),
+                 ~exists().where(and_(usertasks.c.task_id == Task.task_id,
+                                      usertasks.c.email != email))),
+            batch, _log_tasks(log))
+        with engine.begin() as conn:
+            deleted = conn.execute(User.__table__.delete()
+                                   .where(User.email == email)).rowcount
+        if deleted and log is not None:
+            log.append([eventlog.pack(eventlog.USER_DELETED, email=email,
+                                      day=date.today())])
+        total += deleted
+    purge_orphaned_tasks(engine, batch, log)
+    return total
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options
+    define('days', default=90, help='age of notifications or changes to '
+           'purge')
+    define('batch', default=BATCH_SIZE, help='rows deleted per transaction')
+    args = options.parse_command_line()
+    if not args or args[0] not in ('notifications', 'changes', 'tasks',
+                                   'users'):
+        raise SystemExit('usage: python -m cyclence.purge '
+                         'notifications|changes|tasks|users [EMAIL ...]')
+
+    log = eventlog.EventLog(os.getenv('CYCLENCE_EVENT_LOG_DIR')) \
+        if os.getenv('CYCLENCE_EVENT_LOG_DIR') else None
+    count = 0
+    # a user's copies on other shards go too
+    for url in shard_urls():
+        engine = create_engine(url)
+        if args[0] == 'notifications':
+            count += purge_notifications(engine, options.days, options.batch)
+        elif args[0] == 'changes':
+            count += purge_changes(engine, options.days, options.batch)
+        elif args[0] == 'tasks':
+            count += purge_orphaned_tasks(engine, options.batch, log)
+        else:
+            count += purge_users(engine, args[1:], options.batch, log)
+    print('Deleted {} {}'.format(count, args[0]))
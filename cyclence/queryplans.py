@@ -0,0 +1,213 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Checks that the queries the website runs most are using indexes.
+
+Seeds a scratch database with a realistic amount of data, runs EXPLAIN on
+each hot query and reports any that sequentially scan a large table. Never
+point this at a database you care about: `seed` fills it with fake users.
+
+    CYCLENCE_TEST_DB_CONNECTION_STRING=... python -m cyclence.queryplans
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+from datetime import date, datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.orm import sessionmaker
+
+from cyclence.Calendaring import (CyclenceBase, User, Task, Tag, Completion,
+                                  Notification, usertasks, friendships)
+from cyclence.migrations import upgrade
+from cyclence import views, sync, activity, suggestions
+
+# sequential scans of tables smaller than this are fine
+ROW_THRESHOLD = 1000
+
+TAGS = ['chores', 'health', 'car', 'garden', 'bills', 'pets', 'house']
+WORDS = ['water', 'plants', 'change', 'oil', 'sheets', 'vacuum', 'call',
+         'mom', 'pay', 'rent', 'feed', 'cat', 'clean', 'gutters', 'filter']
+
+def _insert(conn, table, rows, batch=5000):
+    rows = list(rows)
+    for i in range(0, len(rows), batch):
+        conn.execute(table.insert(), rows[i:i + batch])
+
+def emails(users):
+    return ['user{}@example.com'.format(i) for i in range(users)]
+
+def seed(engine, users=1000, tasks_per_user=10, completions_per_task=10,
+         notifications_per_user=20, friends_per_user=5):
+    r'''Creates the schema if needed and fills it with fake data. Users who
+    are already there are left alone, so seeding again does nothing.'''
+    CyclenceBase.metadata.create_all(engine)
+    upgrade(engine)
+    rnd = random.Random(0)
+    today = date.today()
+    everyone = emails(users)
+    existing = set(row[0] for row in engine.execute(
+        select([User.email]).where(User.email.in_(everyone))))
+    addresses = [e for e in everyone if e not in existing]
+    if not addresses:
+        return
+    tasks, taskusers, tags, completions, notifications = [], [], [], [], []
+    for email in addresses:
+        for _ in range(tasks_per_user):
+            task_id = str(uuid4())
+            length = rnd.randint(1, 60)
+            tasks.append(dict(task_id=task_id,
+                              name=' '.join(rnd.sample(WORDS, 3)),
+                              length=timedelta(length),
+                              first_due=today - timedelta(length *
+                                                          completions_per_task),
+                              allow_early=rnd.random() < 0.5,
+                              points=100,
+                              decay_length=timedelta(length),
+                              notes=' '.join(rnd.sample(WORDS, 5))))
+            taskusers.append(dict(task_id=task_id, email=email))
+            tags.extend(dict(task_id=task_id, tag_name=tag)
+                        for tag in rnd.sample(TAGS, 2))
+            completions.extend(
+                dict(task_id=task_id,
+                     completed_on=today - timedelta(i * length),
+                     points_earned=rnd.randint(0, 100),
+                     recorded_on=datetime.now(),
+                     days_late=rnd.randint(-2, 5),
+                     email=email)
+                for i in range(1, completions_per_task + 1))
+        notifications.extend(
+            dict(notification_id=str(uuid4()),
+                 email=email,
+                 timestamp=datetime.now() - timedelta(minutes=i),
+                 message='Seeded notification',
+                 noti_type='message')
+            for i in range(notifications_per_user))
+    with engine.begin() as conn:
+        _insert(conn, User.__table__,
+                (dict(email=e, name=e.split('@')[0]) for e in addresses))
+        _insert(conn, Task.__table__, tasks)
+        _insert(conn, usertasks, taskusers)
+        _insert(conn, Tag.__table__, tags)
+        _insert(conn, Completion.__table__, completions)
+        _insert(conn, Notification.__table__, notifications)
+        _insert(conn, friendships,
+                (dict(email_1=everyone[i],
+                      email_2=everyone[(i + k) % users])
+                 for i in range(users) if everyone[i] not in existing
+                 for k in range(1, friends_per_user + 1)))
+        # make sure the planner knows how big the tables are
+        conn.execute('ANALYZE')
+
+def hot_queries(session, email):
+    r'''The queries run on most page loads, as (name, query) pairs. A query
+    is an ORM query or a core select. Every query a page or API request
+    runs per user belongs here, so that a change which stops it using an
+    index is caught.'''
+    user = session.query(User).get(email)
+    task_id = session.query(usertasks.c.task_id)\
+                     .filter(usertasks.c.email == email).limit(1).scalar()
+    notification_id = session.query(Notification.notification_id)\
+                             .filter(Notification.email == email)\
+                             .limit(1).scalar()
+    friends = [f.email for f in views.friend_views(session, email)]
+    return [
+        ('current user', session.query(User).filter(User.email == email)),
+        ('task list', views.tasks_query(email)),
+        ('next tasks', views.tasks_query(email, top=5)),
+        ('task list tags', views.tags_query(email)),
+        ('task', views.tasks_query(email, [task_id])),
+        ('task tags', views.tags_query(email, [task_id])),
+        ('task history', views.completions_query(email, [task_id])),
+        ('task sharers', views.sharers_query(email, [task_id])),
+        ('friends', views.friends_query(email)),
+        ('tagged tasks', user.tasks_tagged(TAGS[0])),
+        ('task search', user.search_tasks(WORDS[0])),
+        ('tag counts', user.tag_counts_query()),
+        ('notifications', session.query(Notification)
+                                 .filter(Notification.email == email)
+                                 .order_by(Notification.timestamp.desc())),
+        ('total points', session.query(func.sum(Completion.points_earned))
+                                .filter(Completion.email == email)),
+        ('activity', activity.days_query(
+            email, date.today() - timedelta(activity.DAYS + activity.WINDOW),
+            date.today())),
+        ('friend emails', suggestions.friends_query(email)),
+        ('friend suggestions',
+         suggestions.candidates_query(email, friends)),
+        ('sync purge check', sync.purged_query()),
+        ('sync task page', sync.task_ids_query(email, task_id,
+                                               sync.BATCH_SIZE)),
+        ('sync changes', sync.changes_query(email, 0, 0, sync.BATCH_SIZE)),
+        ('sync notifications', sync.notifications_query(session, email)),
+        ('sync changed notifications',
+         sync.notifications_query(session, email, [notification_id])),
+        ('sync changed friends',
+         sync.friends_among_query(email, friends[:1])),
+    ]
+
+def explain(conn, query):
+    r'''Returns the JSON query plan for `query`'''
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=conn.dialect)
+    plan = conn.execute('EXPLAIN (FORMAT JSON) ' + str(compiled),
+                        compiled.params).scalar()
+    if not isinstance(plan, list): # older psycopg2 doesn't parse json
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+def seq_scans(plan):
+    r'''Yields the names of relations sequentially scanned in `plan`'''
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', ()):
+        for relation in seq_scans(subplan):
+            yield relation
+
+def check(engine, email=None, threshold=ROW_THRESHOLD):
+    r'''Returns (query name, relation, rows) for every hot query that
+    sequentially scans a relation with more than `threshold` rows'''
+    email = email or emails(1)[0]
+    session = sessionmaker(bind=engine)()
+    problems = []
+    try:
+        conn = session.connection()
+        for name, query in hot_queries(session, email):
+            for relation in set(seq_scans(explain(conn, query))):
+                rows = conn.execute('SELECT reltuples FROM pg_class '
+                                    'WHERE relname = %(relation)s',
+                                    relation=relation).scalar()
+                # None if pg_class has no relation by that name
+                if rows is not None and rows > threshold:
+                    problems.append((name, relation, int(rows)))
+    finally:
+        session.close()
+    return problems
+
+
+if __name__ == '__main__':
+    engine = create_engine(os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING'))
+    seed(engine)
+    problems = check(engine)
+    for name, relation, rows in problems:
+        print('{}: sequential scan of {} ({} rows)'.format(name, relation, rows))
+    sys.exit(1 if problems else 0)
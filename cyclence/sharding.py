@@ -0,0 +1,176 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Spreads users over several databases.
+
+If `CYCLENCE_DB_SHARDS` is a space separated list of connection strings,
+each user lives on the one picked by a hash of their email, along with their
+tasks, completions and notifications. A new task's id is chosen to hash to
+the same database as its creator, so a task can be found from its id alone.
+Otherwise everything is in `CYCLENCE_DB_CONNECTION_STRING`, as one shard.
+
+Users on different shards can still be friends and share tasks:
+
+* Someone with a friend or a shared task on another shard has a copy of their
+  user row there, with just their email and name, for the rows that refer to
+  them.
+* A friendship is stored on both friends' shards.
+* A notification is stored on its recipient's shard. Its task may be on
+  another one.
+* A shared task stays on its creator's shard. Everyone sharing it from other
+  shards has a `shard_links` row on their own shard saying it has tasks for
+  them, and their task list is read from all of those.
+
+Writes for other shards are queued on the session and made after it commits,
+each in its own transaction. If one fails, the error is raised after the
+session's own changes have been committed.'''
+
+import os
+from uuid import uuid4
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session, sessionmaker
+
+from cyclence.Calendaring import User, shard_links
+from cyclence.utils import email_md5
+
+def shard_of(key, shards):
+    r'''The shard out of `shards` that `key`, an email or a task id, is on'''
+    if shards == 1:
+        return 0
+    digest = email_md5(key).hexdigest()
+    return int(digest[:8], 16) % shards
+
+def shard_urls():
+    r'''The connection string of each shard, from the environment'''
+    shards = os.getenv('CYCLENCE_DB_SHARDS')
+    if shards:
+        return shards.split()
+    return [os.getenv('CYCLENCE_DB_CONNECTION_STRING')]
+
+class ShardSession(Session):
+    r'''A session on one shard. `defer` queues writes for other shards until
+    this session commits.'''
+
+    router = None
+    shard = 0
+
+    def __init__(self, *args, **kwargs):
+        Session.__init__(self, *args, **kwargs)
+        self.deferred = []
+
+    def defer(self, shard, write):
+        r'''Calls `write(session)` with a session on `shard` once this session
+        has committed, and commits that'''
+        self.deferred.append((shard, write))
+
+    def commit(self):
+        Session.commit(self)
+        deferred, self.deferred = self.deferred, []
+        for shard, write in deferred:
+            session = self.router.session(shard)
+            try:
+                write(session)
+                session.commit()
+            finally:
+                session.close()
+
+    def rollback(self):
+        self.deferred = []
+        Session.rollback(self)
+
+    def close(self):
+        self.deferred = []
+        Session.close(self)
+
+class ShardRouter(object):
+    r'''An engine and a session factory for each shard'''
+
+    def __init__(self, urls, **engine_args):
+        self.engines = [create_engine(url, **engine_args) for url in urls]
+        self.sessionmakers = [
+            sessionmaker(bind=engine, class_=type(
+                'ShardSession', (ShardSession,), dict(router=self, shard=i)))
+            for i, engine in enumerate(self.engines)]
+
+    @classmethod
+    def from_env(cls, **engine_args):
+        return cls(shard_urls(), **engine_args)
+
+    @property
+    def count(self):
+        return len(self.engines)
+
+    def shard_of(self, key):
+        return shard_of(key, self.count)
+
+    def session(self, shard=0):
+        return self.sessionmakers[shard]()
+
+    def session_for(self, email):
+        r'''A session on the shard of the user `email`'''
+        return self.session(self.shard_of(email))
+
+    def task_id_for(self, email):
+        r'''A new task id on the same shard as the user `email`'''
+        shard = self.shard_of(email)
+        while True:
+            task_id = str(uuid4())
+            if self.shard_of(task_id) == shard:
+                return task_id
+
+    def linked_shards(self, session, email):
+        r'''The other shards with tasks shared with the user `email`, from
+        `session` on their own shard'''
+        if self.count == 1:
+            return []
+        return [row[0] for row in session.execute(
+            select([shard_links.c.shard])
+            .where(shard_links.c.email == email)
+            .order_by(shard_links.c.shard))]
+
+    def sessions_for(self, email):
+        r'''Sessions on every shard with tasks of the user `email`, their own
+        shard's first'''
+        home = self.session_for(email)
+        return [home] + [self.session(shard)
+                         for shard in self.linked_shards(home, email)]
+
+def link(session, email, shard):
+    r'''Records on the shard of `session`, which is the user `email`'s own,
+    that they have tasks on `shard`'''
+    if shard == session.shard:
+        return
+    exists = session.execute(select([shard_links.c.shard]).where(
+        (shard_links.c.email == email) & (shard_links.c.shard == shard))).first()
+    if exists is None:
+        session.execute(shard_links.insert().values(email=email, shard=shard))
+
+def find_user(session, email):
+    r'''The user `email` in `session`, copied from their own shard if they
+    aren't on its shard yet. None if there is no such user.'''
+    user = session.query(User).get(email)
+    router = getattr(session, 'router', None)
+    if user is None and router is not None and router.count > 1:
+        theirs = router.session_for(email)
+        try:
+            found = theirs.query(User).get(email)
+            if found is not None:
+                user = User.ghost(session, email, found.name)
+        finally:
+            theirs.close()
+    return user
@@ -0,0 +1,198 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Suggests friends: friends of friends, ranked by how many friends they have
+in common, then by how many tasks they share with the user.
+
+Each user's friends, then their candidates, are looked up the first time
+they are needed and kept per process. A new friendship drops the entries it
+changes, without touching the database, since it arrives as an event on the
+IOLoop; they are looked up again on the next request.
+
+If the database is sharded, a friendship is stored on the shards of both
+friends, so each friend's friendships are read from their own shard, and
+shared tasks from every shard with tasks of the user.'''
+
+from collections import defaultdict
+
+from sqlalchemy import select, func, literal_column
+from sqlalchemy.sql import not_
+
+from cyclence import events
+from cyclence.cache import TTLCache
+from cyclence.Calendaring import User, friendships, usertasks
+from cyclence.views import UserView
+
+SUGGESTIONS = 10
+
+def friends_query(email):
+    r'''The emails of the friends of `email`, as the column `friend`. Each
+    direction of the friendship is looked up by its own index.'''
+    return select([friendships.c.email_2.label('friend')])\
+        .where(friendships.c.email_1 == email)\
+        .union_all(select([friendships.c.email_1])
+                   .where(friendships.c.email_2 == email))
+
+def friends_of(session, email):
+    return set(row[0] for row in session.execute(friends_query(email)))
+
+def friends_of_friends_query(friends):
+    r'''(candidate, via) for each friendship of one of `friends`, looked up
+    by index from both sides'''
+    return select([friendships.c.email_2.label('candidate'),
+                   friendships.c.email_1.label('via')])\
+        .where(friendships.c.email_1.in_(friends))\
+        .union_all(select([friendships.c.email_1, friendships.c.email_2])
+                   .where(friendships.c.email_2.in_(friends)))
+
+def shared_query(email):
+    r'''(other user, tasks shared with them) for everyone `email` shares a
+    task with, including `email`'''
+    me, others = usertasks.alias('me'), usertasks.alias('others')
+    return select([others.c.email.label('candidate'),
+                   literal_column('0').label('mutual'),
+                   func.count(others.c.task_id.distinct()).label('shared')])\
+        .where(me.c.email == email)\
+        .where(others.c.task_id == me.c.task_id)\
+        .group_by(others.c.email)
+
+def candidates_query(email, friends):
+    r'''(candidate, mutual friends, shared tasks) for everyone who is a
+    friend of a friend of `email`, or shares a task with them, and isn't
+    already their friend. `friends` are the emails of their friends, so that
+    their friends can be looked up by index from both sides.'''
+    signals = shared_query(email)
+    if friends:
+        theirs = friends_of_friends_query(friends).alias('theirs')
+        mutual = select([theirs.c.candidate,
+                         func.count(theirs.c.via.distinct()),
+                         literal_column('0')])\
+            .group_by(theirs.c.candidate)
+        signals = signals.union_all(mutual)
+    signals = signals.alias('signals')
+    query = select([signals.c.candidate,
+                    func.sum(signals.c.mutual),
+                    func.sum(signals.c.shared)])\
+        .where(signals.c.candidate != email)\
+        .group_by(signals.c.candidate)
+    if friends:
+        query = query.where(not_(signals.c.candidate.in_(friends)))
+    return query
+
+def candidates(session, email, friends=None):
+    r'''Returns {email: [mutual friends, shared tasks]} for the candidates
+    of `email` (see `candidates_query`)'''
+    if friends is None:
+        friends = friends_of(session, email)
+    return dict((candidate, [int(mutual), int(shared)])
+                for candidate, mutual, shared
+                in session.execute(candidates_query(email, sorted(friends))))
+
+def sharded_candidates(sessions, email, friends, friend_sessions):
+    r'''`candidates` when the database is sharded. `sessions` are on every
+    shard with tasks of `email`, and `friend_sessions` are (session, some of
+    `friends`) with a session on the shard of each of those friends.'''
+    mutual = defaultdict(set)
+    for session, some in friend_sessions:
+        for candidate, via in session.execute(
+                friends_of_friends_query(sorted(some))):
+            mutual[candidate].add(via)
+    scores = dict((candidate, [len(via), 0])
+                  for candidate, via in mutual.items())
+    for session in sessions:
+        for other, _, shared in session.execute(shared_query(email)):
+            scores.setdefault(other, [0, 0])[1] += int(shared)
+    for known in set(friends) | set([email]):
+        scores.pop(known, None)
+    return scores
+
+class Suggestion(UserView):
+    r'''Someone the user might want to befriend'''
+
+    __slots__ = ('mutual', 'shared')
+
+    def __init__(self, email, name, mutual, shared):
+        UserView.__init__(self, email, name)
+        self.mutual = mutual
+        self.shared = shared
+
+class Suggestions(object):
+    r'''Each user's friend candidates, cached per process'''
+
+    def __init__(self, shard_of=None, ttl=24 * 60 * 60):
+        # shard_of(email) is the shard of a user, if the database is sharded
+        self.shard_of = shard_of
+        self.cache = TTLCache(ttl) # email -> (friends, candidates)
+
+    def get(self, sessions, email, limit=SUGGESTIONS, session_on=None):
+        r'''The best `limit` `Suggestion`s for the user `email`. `sessions`
+        are on every shard with their tasks, their own shard's first. If the
+        database is sharded, `session_on(shard)` is a session on any shard.'''
+        home = sessions[0]
+        entry = self.cache.get(email)
+        if entry is None:
+            friends = friends_of(home, email)
+            if self.shard_of is None:
+                scores = candidates(home, email, friends)
+            else:
+                by_shard = self._by_shard(friends, session_on)
+                scores = sharded_candidates(sessions, email, friends, by_shard)
+            entry = (friends, scores)
+            self.cache.set(email, entry)
+        ranked = sorted(entry[1].items(),
+                        key=lambda item: (-item[1][0], -item[1][1], item[0]))
+        ranked = [(e, scores) for e, scores in ranked if scores[0] or scores[1]]
+        ranked = ranked[:limit]
+        if not ranked:
+            return []
+        emails = [e for e, _ in ranked]
+        if self.shard_of is None:
+            groups = [(home, emails)]
+        else:
+            groups = self._by_shard(emails, session_on)
+        names = {}
+        for session, some in groups:
+            names.update(session.execute(
+                select([User.email, User.name])
+                .where(User.email.in_(some))).fetchall())
+        return [Suggestion(e, names[e], mutual, shared)
+                for e, (mutual, shared) in ranked if e in names]
+
+    def _by_shard(self, emails, session_on):
+        r'''(session, emails on its shard) for the shards of `emails`'''
+        by_shard = defaultdict(list)
+        for email in emails:
+            by_shard[self.shard_of(email)].append(email)
+        return [(session_on(shard), by_shard[shard])
+                for shard in sorted(by_shard)]
+
+    def on_event(self, event):
+        # both new friends get an event, only handle one of them
+        if event['kind'] == events.FRIENDS and \
+                event['email'] == event['friends'][0]:
+            self.befriended(*event['friends'])
+
+    def befriended(self, a, b):
+        r'''Drops the cached candidates that a new friendship between `a` and
+        `b` changes: theirs, and those of their friends'''
+        for email in self.cache.keys():
+            entry = self.cache.get(email)
+            if entry is None:
+                continue
+            friends = entry[0]
+            if email in (a, b) or a in friends or b in friends:
+                self.cache.invalidate(email)
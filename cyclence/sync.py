@@ -0,0 +1,231 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Lets clients fetch only what changed since they last synced.
+
+Triggers record every change a user can see in the `changes` table. A cursor
+is the (transaction id, version) of the last change a client has seen.
+Sending everything is done a page of tasks at a time; until the last page
+the cursor also holds the id of the last task sent.
+Changes are only handed out once every transaction with a lower id has
+finished, so a change committed late by a slow transaction can't be skipped.
+If the changes after a cursor have been purged (see `purged_changes`), the
+client gets everything again instead.
+
+If the database is sharded, each shard with tasks of the user is synced with
+its own cursor, and `sync_all` combines them into one.'''
+
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.sql import and_, or_, exists
+
+from cyclence.Calendaring import (Notification, User, changes, friendships,
+                                  usertasks, purged_changes,
+                                  TASK_ENTITY, NOTIFICATION_ENTITY,
+                                  FRIEND_ENTITY)
+from cyclence.views import task_views, friend_views, UserView
+
+BATCH_SIZE = 500
+
+class InvalidCursor(ValueError):
+    pass
+
+def parse_cursor(cursor):
+    r'''Returns (txid, version, id of the last task sent or None)'''
+    try:
+        parts = cursor.split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError(cursor)
+        after = parts[2] if len(parts) == 3 else None
+        return int(parts[0]), int(parts[1]), after
+    except ValueError:
+        raise InvalidCursor('Not a sync cursor: {!r}'.format(cursor))
+
+def format_cursor(txid, version, after=None):
+    if after is not None:
+        return '{}:{}:{}'.format(txid, version, after)
+    return '{}:{}'.format(txid, version)
+
+def parse_cursors(cursor):
+    r'''{shard: cursor} from a cursor made by `format_cursors`. Empty for
+    cursors from before shards had their own.'''
+    cursors = {}
+    for part in cursor.split(','):
+        shard, sep, rest = part.partition('=')
+        if not sep:
+            return {}
+        try:
+            shard = int(shard)
+        except ValueError:
+            raise InvalidCursor('Not a sync cursor: {!r}'.format(cursor))
+        parse_cursor(rest)
+        cursors[shard] = rest
+    return cursors
+
+def format_cursors(cursors):
+    r'''One cursor for the {shard: cursor} `cursors`, like "0=812:3,2=97:0"'''
+    return ','.join('{}={}'.format(shard, cursors[shard])
+                    for shard in sorted(cursors))
+
+class Delta(object):
+    r'''The current state of whatever changed, and the cursor to sync from
+    next time. If `reset` is true, this is the first page of everything the
+    user has and the client should throw away what it had. If `more` is
+    true, there is more to fetch straight away.'''
+
+    def __init__(self, cursor, more=False, reset=False):
+        self.cursor = cursor
+        self.more = more
+        self.reset = reset
+        self.tasks = []
+        self.notifications = []
+        self.friends = []
+        self.removed = {TASK_ENTITY: [], NOTIFICATION_ENTITY: [],
+                        FRIEND_ENTITY: []}
+
+def _finished_before(session):
+    r'''Every transaction with an id below this has committed or aborted'''
+    return session.execute(
+        select([func.txid_snapshot_xmin(func.txid_current_snapshot())])
+    ).scalar()
+
+def purged_query():
+    r'''The id of the newest transaction whose changes were purged'''
+    return select([func.max(purged_changes.c.txid)])
+
+def task_ids_query(email, after, limit):
+    r'''The ids of up to `limit` tasks of `email` after the task id `after`,
+    in order'''
+    query = select([usertasks.c.task_id]).where(usertasks.c.email == email)
+    if after is not None:
+        query = query.where(usertasks.c.task_id > after)
+    return query.order_by(usertasks.c.task_id).limit(limit)
+
+def changes_query(email, txid, version, limit):
+    r'''Up to `limit` changes for `email` after the cursor (`txid`,
+    `version`), from transactions that have all finished'''
+    return select([changes.c.txid, changes.c.version, changes.c.entity,
+                   changes.c.entity_id])\
+        .where(changes.c.email == email)\
+        .where(tuple_(changes.c.txid, changes.c.version) > (txid, version))\
+        .where(changes.c.txid < func.txid_snapshot_xmin(
+            func.txid_current_snapshot()))\
+        .order_by(changes.c.txid, changes.c.version)\
+        .limit(limit)
+
+def notifications_query(session, email, notification_ids=None):
+    r'''The notifications of `email`, or just `notification_ids`, oldest
+    first'''
+    query = session.query(Notification).filter(Notification.email == email)
+    if notification_ids is not None:
+        query = query.filter(
+            Notification.notification_id.in_(notification_ids))
+    return query.order_by(Notification.timestamp)
+
+def friends_among_query(email, others):
+    r'''The users in `others` who are friends of `email`'''
+    return select([User.email, User.name]).where(and_(
+        User.email.in_(others),
+        or_(exists().where(and_(friendships.c.email_1 == email,
+                                friendships.c.email_2 == User.email)),
+            exists().where(and_(friendships.c.email_2 == email,
+                                friendships.c.email_1 == User.email)))))
+
+def _purged(session, txid):
+    r'''Whether changes after the transaction `txid` may have been purged.
+    Purges remove whole transactions, oldest first.'''
+    purged = session.execute(purged_query()).scalar()
+    return purged is not None and txid <= purged
+
+def sync(session, email, cursor=None, limit=BATCH_SIZE):
+    r'''Returns a `Delta` of up to `limit` changes for the user `email` since
+    `cursor`, or of a page of up to `limit` tasks of everything if there is
+    no cursor.'''
+    if cursor is not None:
+        txid, version, after = parse_cursor(cursor)
+        if not _purged(session, txid):
+            if after is not None:
+                return _everything(session, email, txid, limit, after)
+            return _changes_since(session, email, txid, version, limit)
+    # anything not finished yet will be picked up from the cursor afterwards
+    return _everything(session, email, _finished_before(session), limit)
+
+def sync_all(sessions, email, cursor=None, limit=BATCH_SIZE):
+    r'''`sync` over `sessions`, one on each shard with tasks of the user
+    `email`, their own shard's first, with one cursor for all of them. If
+    any shard has to send everything, they all do, since the client throws
+    away what it had. Notifications and friends come from the user's own
+    shard.'''
+    cursors = parse_cursors(cursor) if cursor is not None else {}
+    shards = [getattr(session, 'shard', 0) for session in sessions]
+    deltas = [sync(session, email, cursors.get(shard), limit)
+              for session, shard in zip(sessions, shards)]
+    if any(d.reset for d in deltas) and not all(d.reset for d in deltas):
+        deltas = [d if d.reset else sync(session, email, None, limit)
+                  for session, d in zip(sessions, deltas)]
+    home = deltas[0]
+    delta = Delta(format_cursors(dict((shard, d.cursor) for shard, d
+                                      in zip(shards, deltas))),
+                  more=any(d.more for d in deltas), reset=home.reset)
+    delta.tasks = [task for d in deltas for task in d.tasks]
+    delta.notifications = home.notifications
+    delta.friends = home.friends
+    delta.removed = dict(home.removed)
+    delta.removed[TASK_ENTITY] = sorted(
+        set(task_id for d in deltas for task_id in d.removed[TASK_ENTITY]))
+    return delta
+
+def _everything(session, email, txid, limit, after=None):
+    task_ids = [row[0] for row in
+                session.execute(task_ids_query(email, after, limit))]
+    more = len(task_ids) == limit
+    delta = Delta(format_cursor(txid, 0, task_ids[-1] if more else None),
+                  more=more, reset=after is None)
+    if task_ids:
+        delta.tasks = task_views(session, email, task_ids)
+    if after is None:
+        delta.notifications = notifications_query(session, email).all()
+        delta.friends = friend_views(session, email)
+    return delta
+
+def _changes_since(session, email, txid, version, limit):
+    rows = session.execute(
+        changes_query(email, txid, version, limit)).fetchall()
+    if not rows:
+        return Delta(format_cursor(txid, version))
+    delta = Delta(format_cursor(rows[-1][0], rows[-1][1]),
+                  more=len(rows) == limit)
+    changed = {TASK_ENTITY: set(), NOTIFICATION_ENTITY: set(),
+               FRIEND_ENTITY: set()}
+    for _, _, entity, entity_id in rows:
+        changed[entity].add(entity_id)
+
+    if changed[TASK_ENTITY]:
+        delta.tasks = task_views(session, email, list(changed[TASK_ENTITY]))
+    if changed[NOTIFICATION_ENTITY]:
+        delta.notifications = notifications_query(
+            session, email, changed[NOTIFICATION_ENTITY]).all()
+    if changed[FRIEND_ENTITY]:
+        delta.friends = [UserView(*row) for row in session.execute(
+            friends_among_query(email, changed[FRIEND_ENTITY]))]
+
+    found = {TASK_ENTITY: [t.task_id for t in delta.tasks],
+             NOTIFICATION_ENTITY: [n.notification_id
+                                   for n in delta.notifications],
+             FRIEND_ENTITY: [f.email for f in delta.friends]}
+    for entity, ids in changed.items():
+        delta.removed[entity] = sorted(ids - set(found[entity]))
+    return delta
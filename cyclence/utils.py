@@ -17,6 +17,7 @@
 
 '''Utility functions for Cyclence'''
 from datetime import datetime, timedelta, date
+from hashlib import md5
 
 def relative_time(dt):
     if dt is None:
@@ -138,6 +139,14 @@ def hue_string(task):
     hue = task_hue(task.point_worth(), task.points, task.dueity == 'not due')
     return 'hsl({},{}%,{}%)'.format(*hue)
 
+def email_md5(email):
+    '''The md5 hash of `email`, ignoring case and surrounding whitespace'''
+    return md5(email.strip().lower().encode('utf-8'))
+
+def gravatar_hash(email):
+    '''The hash gravatar uses to identify the avatar for an email address'''
+    return email_md5(email).hexdigest()
+
 def random_img(background_dir, web_dir):
     import random, os, os.path
     files = [f for f in os.listdir(background_dir) if not f.endswith('_@2X.png')]
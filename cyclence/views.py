@@ -0,0 +1,176 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Read only views of tasks, completions and friends for rendering pages.
+
+These are loaded with a handful of plain queries instead of through the ORM,
+so there is no identity map or relationship state to pay for. A `TaskView`
+follows the same scheduling rules as a `Task`.'''
+
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.sql import and_
+
+from cyclence import utils
+from cyclence.Calendaring import (Recurrence, Task, Tag, Completion, User,
+                                  usertasks, friendships)
+
+TASK_COLUMNS = ('task_id', 'name', 'length', 'first_due', 'allow_early',
+                'points', 'decay_length', 'notes', 'last_completed')
+
+class TaskView(Recurrence):
+    r'''A task as shown on the task list'''
+
+    __slots__ = TASK_COLUMNS + ('tags', 'users', 'completions', 'as_of')
+
+    def __init__(self, row):
+        for column in TASK_COLUMNS:
+            setattr(self, column, row[column])
+        self.as_of = None
+        self.tags = set()
+        self.users = [] # everyone the task is shared by
+        self.completions = [] # oldest first
+
+class CompletionView(object):
+    r'''A completion as shown in a task's history'''
+
+    __slots__ = ('completed_on', 'days_late', 'points_earned', 'completer_name')
+
+    def __init__(self, completed_on, days_late, points_earned, completer_name):
+        self.completed_on = completed_on
+        self.days_late = days_late
+        self.points_earned = points_earned
+        self.completer_name = completer_name
+
+class UserView(object):
+    r'''Another user, as shown in friend lists and task sharers'''
+
+    __slots__ = ('email', 'name')
+
+    def __init__(self, email, name):
+        self.email = email
+        self.name = name
+
+    @property
+    def gravatar_url(self):
+        return 'http://www.gravatar.com/avatar/{hash}'.format(
+            hash = utils.gravatar_hash(self.email))
+
+
+def _tasks_of(email, task_ids, task_id_column):
+    r'''Restricts a query to tasks belonging to `email`, and optionally to
+    `task_ids`'''
+    clause = and_(usertasks.c.task_id == task_id_column,
+                  usertasks.c.email == email)
+    if task_ids is not None:
+        clause = and_(clause, task_id_column.in_(task_ids))
+    return clause
+
+def tasks_query(email, task_ids=None, top=None):
+    r'''The columns of a `TaskView` for the tasks of `email`, highest
+    priority first'''
+    columns = [Task.task_id, Task.name, Task.length, Task.first_due,
+               Task.allow_early, Task.points, Task.decay_length, Task.notes,
+               Task.last_completed.label('last_completed')]
+    query = select(columns).where(_tasks_of(email, task_ids, Task.task_id))\
+                           .order_by(Task.sort_value.desc(), Task.name)
+    if top is not None:
+        query = query.where(Task.sort_value > 0).limit(top)
+    return query
+
+def tags_query(email, task_ids=None):
+    return select([Tag.task_id, Tag.tag_name])\
+        .where(_tasks_of(email, task_ids, Tag.task_id))
+
+def completions_query(email, task_ids=None):
+    # the completer is gone if their account was deleted
+    return select([Completion.task_id, Completion.completed_on,
+                   Completion.days_late, Completion.points_earned, User.name])\
+        .select_from(Completion.__table__.outerjoin(
+            User.__table__, User.email == Completion.email))\
+        .where(_tasks_of(email, task_ids, Completion.task_id))\
+        .order_by(Completion.completed_on)
+
+def sharers_query(email, task_ids=None):
+    sharers = usertasks.alias('sharers')
+    return select([sharers.c.task_id, User.email, User.name])\
+        .where(_tasks_of(email, task_ids, sharers.c.task_id))\
+        .where(User.email == sharers.c.email)\
+        .order_by(User.name)
+
+def task_views(session, email, task_ids=None, details=True, top=None):
+    r'''Returns `TaskView`s for the tasks of the user `email`, highest
+    priority first, optionally only those in `task_ids`. If `top` is given,
+    only that many of the tasks that should be done next are returned. If
+    `details` is false, the completion history and sharers are left empty.'''
+    tasks = OrderedDict()
+    for row in session.execute(tasks_query(email, task_ids, top)):
+        tasks[row['task_id']] = TaskView(row)
+    if not tasks:
+        return []
+    if top is not None:
+        # only load the rest for the tasks that made the cut
+        task_ids = list(tasks)
+
+    for task_id, tag_name in session.execute(tags_query(email, task_ids)):
+        tasks[task_id].tags.add(tag_name)
+
+    if details:
+        for row in session.execute(completions_query(email, task_ids)):
+            tasks[row[0]].completions.append(CompletionView(*row[1:]))
+        for task_id, sharer, name in session.execute(
+                sharers_query(email, task_ids)):
+            tasks[task_id].users.append(UserView(sharer, name))
+
+    return list(tasks.values())
+
+def all_task_views(sessions, email, **kwargs):
+    r'''`task_views` of the user `email` from each session in `sessions`, for
+    tasks spread over several databases. Highest priority first.'''
+    tasks = [task for session in sessions
+             for task in task_views(session, email, **kwargs)]
+    tasks.sort(key=lambda t: (-t.sort_value, t.name))
+    if kwargs.get('top') is not None:
+        return tasks[:kwargs['top']]
+    return tasks
+
+def dashboard(sessions, email, day):
+    r'''The task list of the user `email` as it will be on `day`, from their
+    tasks in each of `sessions`, highest priority first. Completions and
+    sharers are left out.'''
+    tasks = [task for session in sessions
+             for task in task_views(session, email, details=False)]
+    for task in tasks:
+        task.as_of = day
+    # the same order as task_views, but on `day` instead of today
+    tasks.sort(key=lambda t: (-t.sort_value, t.name))
+    return tasks
+
+def friends_query(email):
+    followers = select([User.email, User.name])\
+        .where(friendships.c.email_1 == email)\
+        .where(friendships.c.email_2 == User.email)
+    followees = select([User.email, User.name])\
+        .where(friendships.c.email_2 == email)\
+        .where(friendships.c.email_1 == User.email)
+    friends = followers.union_all(followees).alias('friends')
+    return select([friends]).order_by(friends.c.name)
+
+def friend_views(session, email):
+    r'''Returns `UserView`s for the friends of the user `email`, by name'''
+    return [UserView(*row) for row in session.execute(friends_query(email))]
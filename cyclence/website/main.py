@@ -19,18 +19,32 @@ from __future__ import print_function
 
 import os
 import os.path
+import time
+import random
 from os.path import join as ojoin
 from base64 import urlsafe_b64decode as b64decode
 from uuid import uuid4
 from datetime import date, datetime, timedelta
+from datetime import time as dt_time
 from functools import wraps
+from collections import Counter
 
 from tornado import ioloop, web, auth, escape
 from tornado.httpclient import HTTPError
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 import cyclence.Calendaring as orm
+from cyclence import utils, events
+from cyclence.views import task_views, all_task_views, friend_views
+from cyclence.cache import TTLCache
+from cyclence.events import EventListener
+from cyclence.profiling import Profiler
+from cyclence.admission import AdmissionControl, HTTPServer, LIGHT, HEAVY
+from cyclence.dashboards import Dashboards
+from cyclence.eventlog import EventLog
+from cyclence.sync import sync_all, InvalidCursor, BATCH_SIZE as SYNC_BATCH_SIZE
+from cyclence.activity import activity
+from cyclence.suggestions import Suggestions
+from cyclence.sharding import ShardRouter, link, find_user
 from cyclence.utils import date_str
 
 UUID_REGEX = r'[\dA-Fa-f]{8}-[\dA-Fa-f]{4}-[\dA-Fa-f]{4}'\
@@ -38,13 +52,28 @@ UUID_REGEX = r'[\dA-Fa-f]{8}-[\dA-Fa-f]{4}-[\dA-Fa-f]{4}'\
 
 DATE_REGEX = r'[\d]{4}-[\d]{2}-[\d]{2}'
 
+POLL_TIMEOUT = 30 # seconds
+
+# bump when the contents of the user cookie change
+COOKIE_VERSION = 1
+
+NEXT_TASKS = 5
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+# pages reload at a random time this many seconds after midnight, so that
+# they don't all reload at once
+REFRESH_JITTER = 600
+
 def rollback_on_failure(method):
     @wraps(method)
     def wrapped(self, *args, **kwargs):
         try:
             method(self, *args, **kwargs)
         except:
-            self.session.rollback()
+            for session in self.sessions.values():
+                session.rollback()
             raise
     return wrapped
 
@@ -54,13 +83,168 @@ def parsedate(datestr):
         return None
     return datetime.strptime(datestr, '%Y-%m-%d').date()
 
+def isodate(dt):
+    'Formats a date in ISO8601 format'
+    return dt.isoformat() if dt is not None else None
+
+def user_cookie(user):
+    'The value of the signed user cookie: a snapshot of the user\'s profile'
+    return escape.json_encode(dict(v=COOKIE_VERSION,
+                                   email=user.email,
+                                   name=user.name,
+                                   avatar=utils.gravatar_hash(user.email)))
+
+def parse_user_cookie(value):
+    r'''Returns the profile snapshot from a user cookie. Cookies set before the
+    snapshot was added only contain the email address.'''
+    if not value:
+        return None
+    try:
+        profile = escape.json_decode(value)
+    except ValueError:
+        return dict(email=value)
+    if not isinstance(profile, dict) or profile.get('v') != COOKIE_VERSION:
+        return None
+    return profile
+
+def seconds_until_refresh(now=None):
+    r'''How long a page should wait before reloading for the new day'''
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(1), dt_time())
+    return int((midnight - now).total_seconds()) + \
+        random.randint(1, REFRESH_JITTER)
+
+def task_json(task):
+    'A JSON serializable representation of a task'
+    return dict(task_id=task.task_id,
+                name=task.name,
+                length=task.length.days,
+                first_due=isodate(task.first_due),
+                allow_early=task.allow_early,
+                points=task.points,
+                decay_length=task.decay_length.days,
+                notes=task.notes,
+                tags=sorted(task.tags),
+                last_completed=isodate(task.last_completed),
+                duedate=isodate(task.duedate),
+                dueity=task.dueity,
+                point_worth=task.point_worth())
+
+def task_detail_json(task, shareables=None):
+    'A task with its history, sharers and the friends it could be shared with'
+    detail = task_json(task)
+    detail.update(
+        completions=[dict(completed_on=isodate(c.completed_on),
+                          days_late=c.days_late,
+                          points_earned=c.points_earned,
+                          completer_name=c.completer_name)
+                     for c in reversed(task.completions)],
+        users=[dict(email=u.email, name=u.name) for u in task.users])
+    if shareables is not None:
+        detail.update(shareable=[dict(email=f.email, name=f.name)
+                                 for f in shareables])
+    return detail
+
+def notification_json(note):
+    'A JSON serializable representation of a notification'
+    return dict(notification_id=note.notification_id,
+                timestamp=note.timestamp.isoformat(),
+                message=note.message,
+                noti_type=note.noti_type,
+                sender=note.sender,
+                task_id=note.task_id)
+
 class BaseHandler(web.RequestHandler):
 
+    # whether requests to this handler can be profiled
+    profiled = True
+
+    # how much work a request takes, for admission control. None if it isn't
+    # subject to it.
+    cost = HEAVY
+
     def initialize(self, *args, **kwargs):
-        self.session = sessionmaker(bind=self.application.engine)()
+        self.sessions = {} # shard -> session, opened when first used
+        self.profile_run = None
+        self.admitted = False
+
+    def prepare(self):
+        if self.cost is not None:
+            admission = self.application.admission
+            reason = admission.admit(self.cost, self.request)
+            if reason is not None:
+                # send_error would drop the Retry-After header
+                self.set_status(503)
+                self.set_header('Retry-After', admission.retry_after)
+                self.finish('Too busy ({}), please try again shortly'
+                            .format(reason))
+                return
+            self.admitted = True
+        profiler = self.application.profiler
+        if self.profiled and profiler.wanted(self.request):
+            self.profile_run = profiler.start()
 
     def on_finish(self):
-        self.session.close()
+        if self.admitted:
+            self.application.admission.release(self.cost)
+        if self.request.method == 'POST' and self.profile is not None:
+            # the next page this user sees should show what they just did
+            self.application.forget_tasks(self.profile['email'])
+        if self.profile_run is not None:
+            self.application.profiler.finish(self.profile_run, self.request,
+                                             self.get_status())
+        self.close_sessions()
+
+    def shard_session(self, shard):
+        r'''This request's session on `shard`'''
+        if shard not in self.sessions:
+            self.sessions[shard] = self.application.router.session(shard)
+        return self.sessions[shard]
+
+    @property
+    def session(self):
+        r'''This request's session on the current user's shard'''
+        email = self.profile['email'] if self.profile is not None else ''
+        return self.shard_session(self.application.router.shard_of(email))
+
+    def task_session(self, task_id):
+        r'''This request's session on the shard of the task `task_id`'''
+        return self.shard_session(self.application.router.shard_of(task_id))
+
+    def task_sessions(self):
+        r'''Sessions on every shard with tasks of the current user'''
+        return [self.session] + [self.shard_session(shard) for shard in
+                                 self.application.router.linked_shards(
+                                     self.session, self.current_user.email)]
+
+    def user_in(self, session):
+        r'''The current user in `session`, which may be on another shard'''
+        if session is self.session:
+            return self.current_user
+        return orm.User.ghost(session, self.current_user.email,
+                              self.current_user.name)
+
+    def task_users(self):
+        r'''The current user in each of `task_sessions`'''
+        return [self.user_in(session) for session in self.task_sessions()]
+
+    def commit(self, *sessions):
+        r'''Commits `sessions` in order, skipping repeats, then the current
+        user's session'''
+        committed = []
+        for session in sessions + (self.session,):
+            if session not in committed:
+                session.commit()
+                committed.append(session)
+
+    def close_sessions(self):
+        for session in self.sessions.values():
+            session.close()
+
+    def get_template_namespace(self):
+        namespace = web.RequestHandler.get_template_namespace(self)
+        namespace.update(refresh_in=seconds_until_refresh())
+        return namespace
 
     @property
     def json(self):
@@ -69,14 +253,61 @@ class BaseHandler(web.RequestHandler):
         return self._json
 
 
+    @property
+    def profile(self):
+        r'''The profile snapshot from the signed user cookie. Identifies the
+        user without touching the database.'''
+        if not hasattr(self, '_profile'):
+            self._profile = parse_user_cookie(self.get_secure_cookie('user'))
+        return self._profile
+
     def get_current_user(self):
         if not hasattr(self, '_user'):
-            email = self.get_secure_cookie('user')
-            if not email:
+            if self.profile is None:
                 return None
-            self._user = self.session.query(orm.User).filter(orm.User.email == email).first()
+            self._user = self.application.load_user(self.session,
+                                                    self.profile['email'])
         return self._user
 
+    def paginate(self, queries, key):
+        r'''Applies the `page` and `per_page` arguments to `queries`, one per
+        shard, merging their rows in the order of `key`. Returns the rows for
+        the page, the page number and whether there are more pages'''
+        try:
+            page = max(1, int(self.get_argument('page', 1)))
+            per_page = int(self.get_argument('per_page', PAGE_SIZE))
+        except ValueError:
+            raise web.HTTPError(400, 'page and per_page must be integers')
+        per_page = min(max(1, per_page), MAX_PAGE_SIZE)
+        # fetch one extra row to find out if there is a next page
+        if len(queries) == 1:
+            rows = queries[0].limit(per_page + 1)\
+                             .offset((page - 1) * per_page).all()
+        else:
+            # each shard's rows up to the end of the page, merged
+            rows = sorted((row for query in queries
+                           for row in query.limit(page * per_page + 1)),
+                          key=key)[(page - 1) * per_page:]
+        return rows[:per_page], page, len(rows) > per_page
+
+    def write_tasks(self, queries):
+        r'''Writes a page of tasks from `queries`, one for each shard with the
+        current user's tasks, as JSON'''
+        tasks, page, more = self.paginate(
+            [query.order_by(orm.Task.name, orm.Task.task_id)
+             for query in queries],
+            key=lambda t: (t.name, t.task_id))
+        self.write(dict(tasks=[task_json(t) for t in tasks],
+                        page=page,
+                        more=more))
+
+    def render_tasklist(self):
+        email = self.current_user.email
+        # details are loaded when a task is opened
+        self.render('tasklist.html',
+                    tasks=self.application.dashboards.get(self.task_sessions(),
+                                                          email))
+
     def redirect(self, url, permanent=False, status=303):
         try:
             web.RequestHandler.redirect(self, url.url, permanent, status)
@@ -95,7 +326,12 @@ class CyclenceApp(web.Application):
                                   Logout,
                                   Google,
                                   Tasks,
+                                  NextTasks,
+                                  TaggedTasks,
+                                  SearchTasks,
+                                  Tags,
                                   Task,
+                                  TaskRow,
                                   NewTask,
                                   EditTasks,
                                   EditTask,
@@ -105,7 +341,12 @@ class CyclenceApp(web.Application):
                                   Notifications,
                                   Notification,
                                   Friends,
+                                  FriendSuggestions,
                                   Invite,
+                                  Events,
+                                  Health,
+                                  Sync,
+                                  Activity,
                                   )
         settings = dict(
             cookie_secret=os.getenv('CYCLENCE_COOKIE_SECRET'),
@@ -113,35 +354,95 @@ class CyclenceApp(web.Application):
             template_path=os.path.join(os.path.dirname(__file__), 'tpl'),
             debug=True if os.getenv('CYCLENCE_DEBUG') == 'true' else False,
             static_path=os.path.join(os.path.dirname(__file__), "../../static"),
+            ui_modules={'NextTasks': NextTasksModule},
             )
-        self.engine = create_engine(self.connection_string, echo=debug)
+        pool = dict((arg, int(os.getenv(var))) for arg, var in
+                    [('pool_size', 'CYCLENCE_DB_POOL_SIZE'),
+                     ('max_overflow', 'CYCLENCE_DB_MAX_OVERFLOW')]
+                    if os.getenv(var))
+        self.router = ShardRouter.from_env(echo=debug, **pool)
+        if os.getenv('CYCLENCE_EVENT_LOG_DIR'):
+            log = EventLog(os.getenv('CYCLENCE_EVENT_LOG_DIR'))
+            for Session in self.router.sessionmakers:
+                log.install(Session)
+        self.user_cache = TTLCache(
+            int(os.getenv('CYCLENCE_USER_CACHE_TTL', 60)))
+        self.events = EventListener(self.router.engines,
+                                    ioloop.IOLoop.instance())
+        self.events.add_handler(self.on_event)
+        self.events.add_reconnect_handler(self.forget_everything)
+        self.dashboards = Dashboards(
+            self.router.sessions_for, ioloop.IOLoop.instance(),
+            int(os.getenv('CYCLENCE_DASHBOARD_TTL', 1200)))
+        self.activity_cache = TTLCache(
+            int(os.getenv('CYCLENCE_ACTIVITY_TTL', 3600)))
+        self.suggestions = Suggestions(
+            self.router.shard_of if self.router.count > 1 else None)
+        self.events.add_handler(self.suggestions.on_event)
+        self.profiler = Profiler(os.getenv('CYCLENCE_PROFILE_DIR'),
+                                 float(os.getenv('CYCLENCE_PROFILE_RATE', 0)),
+                                 int(os.getenv('CYCLENCE_PROFILE_KEEP', 100)),
+                                 settings['cookie_secret'])
+        self.admission = AdmissionControl(
+            int(os.getenv('CYCLENCE_MAX_IN_FLIGHT', 0)),
+            int(os.getenv('CYCLENCE_MAX_HEAVY_IN_FLIGHT', 0)),
+            float(os.getenv('CYCLENCE_QUEUE_BUDGET', 0)),
+            retry_after=int(os.getenv('CYCLENCE_RETRY_AFTER', 2)))
 
         web.Application.__init__(self, handlers, **settings)
 
-    @property
-    def connection_string(self):
-        try:
-            return self._connection_string
-        except AttributeError:
-            self._connection_string = os.getenv('CYCLENCE_DB_CONNECTION_STRING')
-            return self._connection_string
+    def load_user(self, session, email):
+        r'''Returns the user with `email` attached to `session`. Users are
+        cached per process, so this usually doesn't touch the database.'''
+        cached = self.user_cache.get(email)
+        if cached is None:
+            loader = self.router.session_for(email)
+            try:
+                cached = loader.query(orm.User).get(email)
+            finally:
+                loader.close() # leaves `cached` detached with its columns loaded
+            if cached is None:
+                return None
+            self.user_cache.set(email, cached)
+        return session.merge(cached, load=False)
+
+    def on_event(self, event):
+        if event['kind'] in (events.FRIENDS, events.PROFILE):
+            self.user_cache.invalidate(event['email'])
+        # edits by other sharers come with a notification
+        if event['kind'] in (events.TASK, events.NOTIFICATION):
+            self.forget_tasks(event['email'])
+
+    def forget_everything(self):
+        r'''Drops every cached user, task list, heatmap and suggestion, for
+        when events may have been missed'''
+        for cache in (self.user_cache, self.dashboards.cache,
+                      self.activity_cache, self.suggestions.cache):
+            cache.clear()
+
+    def forget_tasks(self, email):
+        r'''Drops everything cached about the tasks and completions of
+        `email`'''
+        self.dashboards.forget(email)
+        self.activity_cache.invalidate((email, date.today()))
 
 class Main(BaseHandler):
     url = "/"
 
     @web.authenticated
     def get(self):
-        self.session.refresh(self.current_user)
-        self.render('tasklist.html')
+        self.render_tasklist()
 
 class Login(BaseHandler):
     url = ojoin(Main.url, "login")
+    cost = LIGHT
 
     def get(self):
         self.render('login.html')
 
 class Logout(BaseHandler):
     url = ojoin(Main.url, 'logout')
+    cost = LIGHT
 
     @web.authenticated
     def get(self):
@@ -161,14 +462,22 @@ class Google(BaseHandler, auth.GoogleMixin):
     def _on_auth(self, user):
         if not user:
             raise web.HTTPError(500, "Google auth failed")
-        self.set_secure_cookie('user', user['email'])
-        if not self.session.query(orm.User).filter_by(email=user['email']).first():
-            usr = orm.User(email=user['email'],
-                       name=user.get('name'),
+        session = self.shard_session(
+            self.application.router.shard_of(user['email']))
+        usr = session.query(orm.User).filter_by(email=user['email']).first()
+        if not usr:
+            usr = orm.User(email=user['email'])
+            session.add(usr)
+        profile = dict(name=user.get('name'),
                        firstname=user.get('first_name'),
                        lastname=user.get('last_name'))
-            self.session.add(usr)
-            self.session.commit()
+        if any(getattr(usr, k) != v for k, v in profile.items()):
+            for k, v in profile.items():
+                setattr(usr, k, v)
+            events.publish(session, usr.email, events.PROFILE)
+        session.commit()
+        self.application.user_cache.invalidate(usr.email)
+        self.set_secure_cookie('user', user_cookie(usr))
         self.redirect(Main)
 
 class Tasks(BaseHandler):
@@ -179,7 +488,7 @@ class Tasks(BaseHandler):
     @web.authenticated
     def get(self):
         '''Renders the task list'''
-        self.render('tasklist.html')
+        self.render_tasklist()
 
     @web.authenticated
     @rollback_on_failure
@@ -194,16 +503,114 @@ class Tasks(BaseHandler):
                  set(self.get_argument('tags', '').replace(',',' ').split()),
                  self.get_argument('notes', None))
         t.user_email = self.current_user.email
+        t.task_id = self.application.router.task_id_for(t.user_email)
         self.current_user.tasks.append(t)
+        t.changed()
         self.session.commit()
         self.redirect(Tasks)
 
+class NextTasks(BaseHandler):
+    r'''The tasks the current user should do next, most important first'''
+
+    url = ojoin(Tasks.url, "next")
+
+    @web.authenticated
+    def get(self):
+        try:
+            limit = min(max(1, int(self.get_argument('n', NEXT_TASKS))),
+                        MAX_PAGE_SIZE)
+        except ValueError:
+            raise web.HTTPError(400, 'n must be an integer')
+        tasks = all_task_views(self.task_sessions(), self.current_user.email,
+                               details=False, top=limit)
+        self.write(dict(tasks=[task_json(t) for t in tasks]))
+
+class NextTasksModule(web.UIModule):
+    r'''Lists the few tasks the current user should do next'''
+
+    def render(self, limit=NEXT_TASKS):
+        tasks = self.handler.application.dashboards.get(
+            self.handler.task_sessions(), self.current_user.email)
+        return self.render_string('nexttasks.html',
+                                  tasks=[t for t in tasks
+                                         if t.sort_value > 0][:limit])
+
+class TaggedTasks(BaseHandler):
+    r'''Lists the current user's tasks with a given tag'''
+
+    url = ojoin(Tasks.url, "tagged", "([^/]+)")
+
+    @web.authenticated
+    def get(self, tag_name):
+        self.write_tasks([user.tasks_tagged(tag_name)
+                          for user in self.task_users()])
+
+class SearchTasks(BaseHandler):
+    r'''Full text search over the current user's task names and notes'''
+
+    url = ojoin(Tasks.url, "search")
+
+    @web.authenticated
+    def get(self):
+        terms = self.get_argument('q', '').strip()
+        if not terms:
+            raise web.HTTPError(400, 'No search terms given')
+        self.write_tasks([user.search_tasks(terms)
+                          for user in self.task_users()])
+
+class Tags(BaseHandler):
+    r'''Lists the current user's tags and how many tasks have each one'''
+
+    url = ojoin(Main.url, "tags")
+
+    @web.authenticated
+    def get(self):
+        counts = Counter()
+        for user in self.task_users():
+            counts.update(dict(user.tag_counts()))
+        tags = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        self.write(dict(tags=[dict(tag_name=name, count=count)
+                              for name, count in tags]))
+
 class Task(BaseHandler):
     r'''Handles updates to a task'''
 
     url = ojoin(Tasks.url, "({})".format(UUID_REGEX))
 
-    #currently no methods
+    @web.authenticated
+    def get(self, task_id):
+        r'''The task's details, history and sharing options. An HTML fragment
+        for the task list's modal, or JSON if asked for.'''
+        email = self.current_user.email
+        tasks = task_views(self.task_session(task_id), email, [task_id])
+        if not tasks:
+            raise web.HTTPError(404)
+        task = tasks[0]
+        friends = friend_views(self.session, email)
+        sharers = set(u.email for u in task.users)
+        shareables = [f for f in friends if f.email not in sharers]
+        if self.get_argument('format', None) == 'json' or \
+                'application/json' in self.request.headers.get('Accept', ''):
+            self.write(task_detail_json(task, shareables))
+        else:
+            self.render('taskdetail.html', task=task, shareables=shareables,
+                        utils=utils)
+
+class TaskRow(BaseHandler):
+    r'''Renders a single row of the task list, so clients can update it in
+    place'''
+
+    url = ojoin(Task.url, "row")
+
+    @web.authenticated
+    def get(self, task_id):
+        email = self.current_user.email
+        tasks = task_views(self.task_session(task_id), email, [task_id],
+                           details=False)
+        if not tasks:
+            raise web.HTTPError(404)
+        self.render('task.html', task=tasks[0], user=self.current_user,
+                    today=date.today(), utils=utils)
 
 class NewTask(BaseHandler):
     r'''Allows creating a new task'''
@@ -223,8 +630,9 @@ class ShareTask(BaseHandler):
     @rollback_on_failure
     def post(self, task_id):
         try:
-            task = self.session.query(orm.Task).filter_by(task_id=task_id).one()
-            if task not in self.current_user.tasks:
+            session = self.task_session(task_id)
+            task = session.query(orm.Task).filter_by(task_id=task_id).one()
+            if self.user_in(session) not in task.users:
                 raise Exception('User does not own this task')
             email = self.get_argument('friend', None)
             if email is None:
@@ -249,7 +657,10 @@ class EditTasks(BaseHandler):
     def get(self):
         '''Shows the task edit selection screen'''
         try:
-            self.render('edittasks.html')
+            self.render('edittasks.html',
+                        tasks=all_task_views(self.task_sessions(),
+                                             self.current_user.email,
+                                             details=False))
         except Exception as e:
             print(str(e))
 
@@ -262,8 +673,9 @@ class EditTask(BaseHandler):
     @rollback_on_failure
     def get(self, task_id):
         '''Shows the form for editing a particular task'''
+        session = self.task_session(task_id)
         try:
-             task = next(task for task in self.current_user.tasks
+             task = next(task for task in self.user_in(session).tasks
                           if str(task.task_id) == task_id)
         except Exception as e:
             self.set_status(404)
@@ -278,8 +690,9 @@ class EditTask(BaseHandler):
     @rollback_on_failure
     def post(self, task_id):
         '''Actually updates the task with the edits'''
+        session = self.task_session(task_id)
         try:
-            task = self.session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
+            task = session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
         except Exception as e:
             self.set_status(404)
         task.name = self.get_argument('taskname', task.name)
@@ -289,8 +702,10 @@ class EditTask(BaseHandler):
         task.points = int(self.get_argument('points', task.points))
         task.tags = self.get_argument('tags', ', '.join(task.tags)).split(',')
         notes = self.get_argument('notes', task.notes)
-        self.current_user.notify('message', 'The task {.name} has been updated'.format(task))
-        self.session.commit()
+        task.notify_users('message', "{.name} has updated the task '{.name}'"
+                          .format(self.current_user, task))
+        task.changed()
+        self.commit(session)
         self.redirect(Tasks)
 
 
@@ -306,17 +721,24 @@ class DeleteTask(BaseHandler):
     @rollback_on_failure
     def post(self, task_id):
         if self.get_argument('delete', 'false') == 'true':
-            task = self.session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
-            if len(task.users) > 1 and self.current_user in task.users:
-                task.users.remove(self.current_user)
+            session = self.task_session(task_id)
+            task = session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
+            user = self.user_in(session)
+            # everyone who had it, before anyone is removed
+            task.changed()
+            if len(task.users) > 1 and user in task.users:
+                task.users.remove(user)
                 self.current_user.notify('message',
                                          "You have been removed from the task '{.name}'"
                                          .format(task))
-            elif len(task.users) == 1 and self.current_user in task.users:
-                self.session.delete(task)
+                task.notify_users('message',
+                                  "{.name} is no longer sharing the task '{.name}'"
+                                  .format(self.current_user, task))
+            elif len(task.users) == 1 and user in task.users:
+                session.delete(task)
                 self.current_user.notify('message',
                                          "The task '{.name}' has been deleted.".format(task))
-            self.session.commit()
+            self.commit(session)
         else:
             print("Didn't get the expected argument delete=true. Hacking?")
         self.redirect(Tasks)
@@ -329,10 +751,14 @@ class Completion(BaseHandler):
     @rollback_on_failure
     def post(self, task_id, completed_on):
         completion_date = parsedate(completed_on)
-        task = self.session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
+        session = self.task_session(task_id)
+        task = session.query(orm.Task).filter(orm.Task.task_id == task_id).one()
         if task.last_completed is None or completion_date > task.last_completed:
-            task.complete(self.current_user, parsedate(completed_on))
-            self.session.commit()
+            task.complete(self.user_in(session), parsedate(completed_on))
+            task.notify_users('message', "{.name} completed the task '{.name}'"
+                              .format(self.current_user, task),
+                              exclude=self.current_user.email)
+            self.commit(session)
         else:
             self.current_user.notify('error',
                                      "You already completed '{}' on {}"
@@ -361,28 +787,42 @@ class Notification(BaseHandler):
     def post(self, notification_id):
         note = self.session.query(orm.Notification)\
             .filter_by(notification_id=notification_id).one()
-        if note not in self.current_user.notifications:
+        if note.email != self.current_user.email:
             pass # will just redirect
         elif self.get_argument('delete', None) == 'true':
-            self.current_user.notifications.remove(note)
+            self.session.delete(note)
             self.session.commit()
         elif note.noti_type == 'befriend' and self.get_argument('accept', 'false') == 'true':
             friend = self.session.query(orm.User).filter_by(email=note.sender).one()
-            self.current_user._followers.append(friend)
+            self.current_user.add_friend(friend)
             friend.notify('message', '{.name} has accepted your friend request'
                           .format(self.current_user))
-            self.current_user.notifications.remove(note)
+            self.session.delete(note)
             self.session.commit()
+            for email in (self.current_user.email, friend.email):
+                self.application.user_cache.invalidate(email)
         elif note.noti_type == 'share' and self.get_argument('accept', 'false') == 'true':
-            task = self.session.query(orm.Task).filter_by(task_id=note.task_id).one()
+            session = self.task_session(note.task_id)
+            task = session.query(orm.Task).filter_by(task_id=note.task_id).first()
+            if task is None:
+                self.current_user.notify('error', 'That task has been deleted')
+                self.session.delete(note)
+                self.session.commit()
+                self.redirect(Notifications)
+                return
             sender = self.session.query(orm.User).filter_by(email=note.sender).one()
-            self.current_user.tasks.append(task)
+            user = self.user_in(session)
+            if user not in task.users:
+                task.users.append(user)
+            task.changed()
+            # the task stays on its own shard
+            link(self.session, self.current_user.email, session.shard)
             self.current_user.notify('message', "You have accepted the task '{.name}'".
                                      format(task))
             sender.notify('message', "{.name} has accepted the task '{.name}'"
                           .format(self.current_user, task))
-            self.current_user.notifications.remove(note)
-            self.session.commit()
+            self.session.delete(note)
+            self.commit(session)
         self.redirect(Notifications)
 
 class Friends(BaseHandler):
@@ -391,7 +831,31 @@ class Friends(BaseHandler):
 
     @web.authenticated
     def get(self):
-        self.render('friendlist.html')
+        email = self.current_user.email
+        self.render('friendlist.html',
+                    friends=friend_views(self.session, email),
+                    suggestions=self.application.suggestions.get(
+                        self.task_sessions(), email,
+                        session_on=self.shard_session))
+
+class FriendSuggestions(BaseHandler):
+    '''People the current user might know, as JSON'''
+    url = ojoin(Friends.url, "suggestions")
+
+    @web.authenticated
+    def get(self):
+        try:
+            limit = min(max(1, int(self.get_argument('n', 10))), MAX_PAGE_SIZE)
+        except ValueError:
+            raise web.HTTPError(400, 'n must be an integer')
+        suggestions = self.application.suggestions.get(
+            self.task_sessions(), self.current_user.email, limit,
+            self.shard_session)
+        self.write(dict(suggestions=[dict(email=s.email,
+                                          name=s.name,
+                                          mutual_friends=s.mutual,
+                                          shared_tasks=s.shared)
+                                     for s in suggestions]))
 
 class Invite(BaseHandler):
     '''Handles an invitation to become friends'''
@@ -404,7 +868,9 @@ class Invite(BaseHandler):
         if email is None:
             redirect(Friends)
             return
-        potential_friend = self.session.query(orm.User).filter_by(email=email).one()
+        potential_friend = find_user(self.session, email)
+        if potential_friend is None:
+            raise web.HTTPError(404, 'No such user')
         if potential_friend == self.current_user:
             self.current_user.notify('error',
                                      'Forever Alone: you tried to befriend yourself')
@@ -413,6 +879,98 @@ class Invite(BaseHandler):
         self.session.commit()
         self.redirect(Friends)
 
+class Events(BaseHandler):
+    '''Long polls for live events for the current user'''
+    url = ojoin(Main.url, 'events')
+
+    # mostly spent waiting, while other requests run
+    profiled = False
+    cost = None
+
+    @web.authenticated
+    @web.asynchronous
+    def get(self):
+        try:
+            since = float(self.get_argument('since', time.time()))
+        except ValueError:
+            raise web.HTTPError(400, 'since must be a timestamp')
+        self.email = self.profile['email']
+        # don't hold a database connection while waiting
+        self.close_sessions()
+        self.timeout = ioloop.IOLoop.instance().add_timeout(
+            time.time() + POLL_TIMEOUT, lambda: self.on_events([]))
+        self.application.events.subscribe(self.email, since, self.on_events)
+
+    def on_events(self, events):
+        self.stop_waiting()
+        if self.request.connection.stream.closed():
+            return
+        now = max([e['ts'] for e in events] or [time.time()])
+        self.finish(dict(events=events, now=now))
+
+    def stop_waiting(self):
+        ioloop.IOLoop.instance().remove_timeout(self.timeout)
+        self.application.events.unsubscribe(self.email, self.on_events)
+
+    def on_connection_close(self):
+        if hasattr(self, 'timeout'):
+            self.stop_waiting()
+
+class Sync(BaseHandler):
+    '''What changed for the current user since the `since` cursor. Without a
+    cursor, everything, a page of tasks at a time. Returns the cursor to use
+    next time. Covers every shard with tasks of the user.'''
+    url = ojoin(Main.url, 'sync')
+
+    @web.authenticated
+    def get(self):
+        try:
+            limit = min(max(1, int(self.get_argument('n', SYNC_BATCH_SIZE))),
+                        SYNC_BATCH_SIZE)
+        except ValueError:
+            raise web.HTTPError(400, 'n must be an integer')
+        try:
+            delta = sync_all(self.task_sessions(), self.current_user.email,
+                             self.get_argument('since', None), limit)
+        except InvalidCursor as e:
+            raise web.HTTPError(400, str(e))
+        self.write(dict(cursor=delta.cursor,
+                        more=delta.more,
+                        reset=delta.reset,
+                        tasks=[task_detail_json(t) for t in delta.tasks],
+                        notifications=[notification_json(n)
+                                       for n in delta.notifications],
+                        friends=[dict(email=f.email, name=f.name)
+                                 for f in delta.friends],
+                        removed=delta.removed))
+
+class Activity(BaseHandler):
+    '''Completions, points and on time rate per day over the last year'''
+    url = ojoin(Main.url, 'activity')
+
+    @web.authenticated
+    def get(self):
+        email = self.current_user.email
+        key = (email, date.today())
+        result = self.application.activity_cache.get(key)
+        if result is None:
+            result = activity(self.task_sessions(), email)
+            self.application.activity_cache.set(key, result)
+        self.write(result)
+
+class Health(BaseHandler):
+    '''Reports this worker's load and shed requests, without touching the
+    database'''
+    url = ojoin(Main.url, 'health')
+
+    profiled = False
+    cost = LIGHT
+
+    def get(self):
+        stats = self.application.admission.stats()
+        stats.update(pid=os.getpid())
+        self.write(stats)
+
 if __name__ == '__main__':
     from tornado.options import define, options
     define("worker_id", default=None, help="Worker id, used to determine port "
@@ -435,5 +993,10 @@ if __name__ == '__main__':
         PORT = int(env_port)
     else:
         PORT = 8801
-    CyclenceApp(debug=DEBUG).listen(PORT)
+    app = CyclenceApp(debug=DEBUG)
+    server = HTTPServer(app)
+    server.bind(PORT, backlog=int(os.getenv('CYCLENCE_LISTEN_BACKLOG', 128)))
+    server.start()
+    app.events.start()
+    app.dashboards.schedule_rollover()
     ioloop.IOLoop.instance().start()
@@ -29,6 +29,7 @@ setup(name = 'cyclence'
                            "supervisor==3.0b1",
                            "fabric==1.6.0",
                            "mailer==0.7.0",
+                           "numpy",
                            ]
 )
 
@@ -17,9 +17,52 @@ You should have received a copy of the GNU Affero General Public License
 along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
 */
 
-Cycl = Cycl || {};
+var Cycl = window.Cycl || {};
 
 Cycl.today = function(){
     var d = new Date()
     return '' + d.getFullYear() + '-' + (d.getMonth() + 1) + '-' + d.getDate();
 }
+
+// Live updates. Long polls /events and updates only what an event touches.
+Cycl.events = {
+    since: null,
+
+    poll: function(){
+        var params = Cycl.events.since === null ? {} : {since: Cycl.events.since};
+        $.ajax({url: '/events', data: params, dataType: 'json', cache: false,
+                success: function(data){
+                    Cycl.events.since = data.now;
+                    _.each(data.events, Cycl.events.handle);
+                    Cycl.events.poll();
+                },
+                error: function(){
+                    // back off, the server may be restarting
+                    setTimeout(Cycl.events.poll, 10000);
+                }});
+    },
+
+    handle: function(event){
+        if (event.kind === 'notification') {
+            var badge = $('#notification-count');
+            badge.text((parseInt(badge.text(), 10) || 0) + 1).removeClass('hide');
+        } else if (event.kind === 'task') {
+            var row = $('#task-' + event.task_id);
+            if (row.length) {
+                $.get('/tasks/' + event.task_id + '/row', function(html){
+                    row.replaceWith(html);
+                });
+            }
+        }
+    }
+};
+
+// Task details are only loaded when someone opens them.
+Cycl.showTask = function(event){
+    event.preventDefault();
+    $.get('/tasks/' + $(this).data('task-detail'), function(html){
+        $('#task-modal').html(html).modal('show');
+    });
+};
+
+$(document).on('click', '[data-task-detail]', Cycl.showTask);
@@ -15,8 +15,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
 
-from Cyclence.Calendaring import RecurringTask
+import os
+import random
 from datetime import timedelta, date
+from uuid import uuid4
+
+import pytest
+
+from cyclence.Calendaring import (Task as RecurringTask, DUE, OVERDUE,
+                                  NOT_DUE)
 
 class TestRecurringTask(object):
 
@@ -34,7 +41,7 @@ class TestRecurringTask(object):
         assert a.decay_length == b.decay_length
         assert a.first_due == b.first_due
         assert a.notes == b.notes
-        assert a.completion_history == b.completion_history == []
+        assert list(a.completions) == list(b.completions) == []
         assert a.notes == b.notes
         
     def test_dueity(self):
@@ -43,19 +50,195 @@ class TestRecurringTask(object):
         yesterday = today - timedelta(1)
 
         a = RecurringTask('Eat Ham', 12, yesterday)
-        assert a.dueity == RecurringTask.OVERDUE
+        assert a.dueity == OVERDUE
         assert a.is_overdue
         assert not a.is_due
         assert not a.is_not_due
         
         b = RecurringTask('Eat Spam', 12, today)
-        assert b.dueity == RecurringTask.DUE
+        assert b.dueity == DUE
         assert b.is_due
         assert not b.is_not_due
         assert not b.is_overdue
 
         c = RecurringTask('Eat Pam', 12, tomorrow)        
-        assert c.dueity == RecurringTask.NOT_DUE
+        assert c.dueity == NOT_DUE
         assert c.is_not_due
         assert not c.is_due
         assert not c.is_overdue
+
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+@pytest.mark.skipif(DB is None, reason='needs a scratch postgres database in '
+                    'CYCLENCE_TEST_DB_CONNECTION_STRING')
+class TestSchedulingInSQL(object):
+    r'''The SQL versions of the scheduling rules agree with the python ones'''
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from cyclence.Calendaring import CyclenceBase
+        from cyclence.migrations import schema_version
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+
+    def teardown_method(self, method):
+        self.drop()
+
+    def seed(self, count=500):
+        from cyclence.Calendaring import Task, Completion, User
+        rnd = random.Random(0)
+        today = date.today()
+        tasks, completions = [], []
+        # (length, days since first due, days since last completion or None)
+        boundaries = [(7, 0, None), (7, 3, None), (7, -3, None), (7, 20, 7),
+                      (7, 20, 8), (7, 20, 6), (1, 5, 1), (30, 60, 0)]
+        for i in range(count):
+            if i < len(boundaries):
+                length, since_first, since_last = boundaries[i]
+            else:
+                length = rnd.randint(1, 60)
+                since_first = rnd.randint(-60, 120)
+                since_last = rnd.choice([None, rnd.randint(0, 90)])
+            task_id = str(uuid4())
+            tasks.append(dict(task_id=task_id, name='task {}'.format(i),
+                              length=timedelta(length),
+                              first_due=today - timedelta(since_first),
+                              allow_early=rnd.random() < 0.5,
+                              points=rnd.choice([10, 100, 120]),
+                              decay_length=timedelta(rnd.randint(1, 30))))
+            if since_last is not None:
+                completions.append(dict(
+                    task_id=task_id, email='a@x.com', points_earned=0,
+                    completed_on=today - timedelta(since_last)))
+        with self.engine.begin() as conn:
+            conn.execute(User.__table__.insert(), [dict(email='a@x.com')])
+            conn.execute(Task.__table__.insert(), tasks)
+            conn.execute(Completion.__table__.insert(), completions)
+
+    def test_hybrids_match_recurrence(self):
+        from sqlalchemy import select
+        from cyclence.Calendaring import Task
+        from cyclence.views import TaskView
+        self.seed()
+        today = date.today()
+        days = [today - timedelta(5), today + timedelta(3)]
+        columns = [Task.task_id, Task.name, Task.length, Task.first_due,
+                   Task.allow_early, Task.points, Task.decay_length,
+                   Task.notes, Task.last_completed.label('last_completed'),
+                   Task.duedate.label('duedate'),
+                   Task.point_worth().label('point_worth'),
+                   Task.sort_value.label('sort_value'),
+                   Task.group.label('group')] + \
+                  [Task.point_worth(day).label('worth_{}'.format(i))
+                   for i, day in enumerate(days)]
+        rows = self.engine.execute(select(columns)).fetchall()
+        assert len(rows) == 500
+        for row in rows:
+            task = TaskView(row)
+            assert row['duedate'] == task.duedate, task.name
+            assert row['point_worth'] == task.point_worth(), task.name
+            assert row['sort_value'] == task.sort_value, task.name
+            assert row['group'] == task.group, task.name
+            for i, day in enumerate(days):
+                assert row['worth_{}'.format(i)] == task.point_worth(day), \
+                    task.name
+
+
+SHARDS = os.getenv('CYCLENCE_TEST_DB_SHARDS', '').split()
+
+@pytest.mark.skipif(len(SHARDS) < 2, reason='needs two or more scratch '
+                    'postgres databases in CYCLENCE_TEST_DB_SHARDS')
+class TestNotificationSend(object):
+    r'''Notifications are written in bulk on each recipient's shard'''
+
+    def setup_method(self, method):
+        from sqlalchemy import event
+        from cyclence.Calendaring import CyclenceBase, User, Notification
+        from cyclence.migrations import schema_version, upgrade
+        from cyclence.sharding import ShardRouter
+        self.router = ShardRouter(SHARDS)
+        self.drop = lambda: [(CyclenceBase.metadata.drop_all(engine),
+                              schema_version.drop(engine, checkfirst=True))
+                             for engine in self.router.engines]
+        self.drop()
+        for engine in self.router.engines:
+            CyclenceBase.metadata.create_all(engine)
+            upgrade(engine)
+        self.sender = 'sender@x.com'
+        home = self.router.shard_of(self.sender)
+        emails = ['user{}@x.com'.format(i) for i in range(20)]
+        # three on the sender's shard, three elsewhere
+        self.recipients = \
+            [e for e in emails if self.router.shard_of(e) == home][:3] + \
+            [e for e in emails if self.router.shard_of(e) != home][:3]
+        for email in [self.sender] + self.recipients:
+            session = self.router.session_for(email)
+            session.add(User(email=email, name=email.split('@')[0]))
+            # an inbox that sending mustn't load
+            Notification.send(session, [email], 'message', 'old')
+            session.commit()
+            session.close()
+        self.statements = []
+        for engine in self.router.engines:
+            event.listen(engine, 'before_cursor_execute', self.record)
+        self.sessions = []
+        self.listeners = []
+        for engine in self.router.engines:
+            raw = engine.raw_connection()
+            raw.connection.set_isolation_level(0) # autocommit
+            raw.cursor().execute('LISTEN cyclence_events')
+            self.listeners.append(raw)
+
+    def teardown_method(self, method):
+        for session in self.sessions:
+            session.close()
+        for raw in self.listeners:
+            raw.close()
+        self.drop()
+
+    def session_for(self, email):
+        session = self.router.session_for(email)
+        self.sessions.append(session)
+        return session
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.statements.append(statement)
+
+    def published(self):
+        import json
+        found = []
+        for raw in self.listeners:
+            raw.connection.poll()
+            found.extend(json.loads(n.payload)
+                         for n in raw.connection.notifies)
+        return found
+
+    def test_one_row_per_recipient_on_their_shard(self):
+        from cyclence.Calendaring import User, Notification
+        session = self.session_for(self.sender)
+        # a repeated recipient is only notified once
+        Notification.send(session, self.recipients + self.recipients[:1],
+                          'message', 'hello', sender=self.sender)
+        session.commit()
+        inserts = [s for s in self.statements
+                   if s.startswith('INSERT INTO notifications')]
+        assert len(inserts) == 2 # one per shard
+        assert not [s for s in self.statements
+                    if s.startswith('SELECT') and 'FROM notifications' in s]
+        for email in self.recipients:
+            session = self.session_for(email)
+            rows = session.query(Notification)\
+                          .filter_by(email=email, message='hello').all()
+            assert [(n.noti_type, n.sender) for n in rows] == \
+                [('message', self.sender)]
+            # the sender is copied to recipients' shards for their name
+            assert session.query(User.name).filter_by(email=self.sender)\
+                          .scalar() == 'sender'
+        events = [e for e in self.published() if e['message'] == 'hello']
+        assert sorted(e['email'] for e in events) == sorted(self.recipients)
+        assert set(e['kind'] for e in events) == set(['notification'])
@@ -0,0 +1,103 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+from datetime import date, timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+from cyclence.activity import aggregate
+
+def test_totals_per_day():
+    # offsets 0 and 1 are only there for the rolling rate
+    completions, points, rate = aggregate(
+        [(0, 1, 10, 1), (2, 2, 25, 1), (4, 1, 7, 1)], days=3, window=3)
+    assert completions.tolist() == [2, 0, 1]
+    assert points.tolist() == [25, 0, 7]
+    assert np.allclose(rate, [2 / 3.0, 1 / 2.0, 2 / 3.0])
+
+def test_no_completions():
+    completions, points, rate = aggregate([], days=4, window=2)
+    assert completions.tolist() == [0] * 4
+    assert points.tolist() == [0] * 4
+    assert np.isnan(rate).all()
+
+def test_days_from_several_shards_add_up():
+    completions, points, rate = aggregate(
+        [(1, 1, 4, 0), (1, 2, 6, 2), (0, 1, 1, 1)], days=1, window=2)
+    assert completions.tolist() == [3]
+    assert points.tolist() == [10]
+    assert np.allclose(rate, [3 / 4.0])
+
+@pytest.mark.skipif(DB is None, reason='needs a scratch postgres database in '
+                    'CYCLENCE_TEST_DB_CONNECTION_STRING')
+def test_totalled_by_the_database():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from cyclence.Calendaring import CyclenceBase, User, Task, Completion
+    from cyclence.migrations import schema_version, upgrade
+    from cyclence.activity import activity
+    engine = create_engine(DB)
+    drop = lambda: (CyclenceBase.metadata.drop_all(engine),
+                    schema_version.drop(engine, checkfirst=True))
+    drop()
+    CyclenceBase.metadata.create_all(engine)
+    upgrade(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        end = date(2013, 6, 30)
+        user, other = User(email='a@x.com', name='A'), \
+            User(email='b@x.com', name='B')
+        session.add_all([user, other])
+        rnd = random.Random(5)
+        expected = {}
+        for i in range(6):
+            task = Task('Task {}'.format(i), 3, end)
+            user.tasks.append(task)
+            for day in rnd.sample(range(40), 25):
+                on = end - timedelta(day)
+                points = rnd.choice([None, 5, 10])
+                late = rnd.choice([None, -1, 0, 2])
+                by = rnd.choice([user, user, other])
+                session.add(Completion(task_id=task.task_id, completed_on=on,
+                                       points_earned=points, days_late=late,
+                                       completer=by))
+                if by is user:
+                    totals = expected.setdefault(on, [0, 0, 0])
+                    totals[0] += 1
+                    totals[1] += points or 0
+                    totals[2] += (late or 0) <= 0
+            session.flush()
+        session.commit()
+        result = activity([session], user.email, end, days=10, window=5)
+        totals = [expected.get(end - timedelta(13 - i), [0, 0, 0])
+                  for i in range(14)]
+        assert result['completions'] == [t[0] for t in totals[4:]]
+        assert result['points'] == [t[1] for t in totals[4:]]
+        for i, rate in enumerate(result['on_time_rate']):
+            window = totals[i:i + 5]
+            done = sum(t[0] for t in window)
+            assert rate == (round(sum(t[2] for t in window) / float(done), 3)
+                            if done else None)
+    finally:
+        session.close()
+        drop()
@@ -0,0 +1,125 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+from cyclence.admission import (AdmissionControl, LIGHT, HEAVY, QUEUE_TIME,
+                                IN_FLIGHT)
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class Request(object):
+    r'''A request read at `start`, on a connection accepted at `accepted`'''
+
+    def __init__(self, start, accepted=None):
+        self._start_time = start
+        class Stream(object):
+            accepted_at = accepted
+        class Connection(object):
+            stream = Stream()
+        self.connection = Connection()
+
+class TestAdmissionControl(object):
+
+    def setup_method(self, method):
+        self.clock = Clock()
+
+    def test_burst_is_shed_once_it_has_waited_too_long(self):
+        admission = AdmissionControl(queue_budget=1.0, clock=self.clock)
+        # six connections accepted together, each read as the last finishes
+        results = []
+        for i in range(6):
+            request = Request(self.clock.now, accepted=1000.0)
+            reason = admission.admit(HEAVY, request)
+            results.append(reason)
+            if reason is None:
+                self.clock.now += 0.5
+                admission.release(HEAVY)
+        assert results == [None, None, None, QUEUE_TIME, QUEUE_TIME,
+                           QUEUE_TIME]
+        assert admission.stats()['shed'][HEAVY] == {QUEUE_TIME: 3}
+        assert admission.max_queue_time == 1.5
+
+    def test_light_requests_get_longer(self):
+        admission = AdmissionControl(queue_budget=1.0, clock=self.clock)
+        self.clock.now += 2
+        assert admission.admit(LIGHT, Request(1000.0, 1000.0)) is None
+        assert admission.admit(HEAVY, Request(1000.0, 1000.0)) == QUEUE_TIME
+
+    def test_kept_alive_requests_wait_from_when_they_are_read(self):
+        admission = AdmissionControl(queue_budget=1.0, clock=self.clock)
+        first = Request(1000.0, accepted=990.0)
+        assert admission.admit(HEAVY, first) == QUEUE_TIME
+        # the next request on the same connection
+        second = Request(1000.0)
+        second.connection = first.connection
+        assert admission.admit(HEAVY, second) is None
+
+    def test_in_flight_limits(self):
+        admission = AdmissionControl(max_in_flight=2, max_heavy=1,
+                                     clock=self.clock)
+        assert admission.admit(HEAVY, Request(1000.0)) is None
+        assert admission.admit(HEAVY, Request(1000.0)) == IN_FLIGHT
+        assert admission.admit(LIGHT, Request(1000.0)) is None
+        assert admission.admit(LIGHT, Request(1000.0)) == IN_FLIGHT
+        admission.release(HEAVY)
+        assert admission.admit(HEAVY, Request(1000.0)) is None
+
+testing = pytest.importorskip('tornado.testing')
+
+class TestShedding(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        from cyclence.website import main
+        saved = dict(os.environ)
+        os.environ['CYCLENCE_DB_CONNECTION_STRING'] = \
+            'postgresql://localhost/unused'
+        os.environ.pop('CYCLENCE_DB_SHARDS', None)
+        try:
+            self.app = main.CyclenceApp()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        return self.app
+
+    def get_http_server(self):
+        from cyclence.admission import HTTPServer
+        return HTTPServer(self._app, io_loop=self.io_loop)
+
+    def test_waited_too_long_gets_503(self):
+        import time
+        # every request looks like it has waited a minute
+        self.app.admission = AdmissionControl(queue_budget=1.0,
+                                              retry_after=5,
+                                              clock=lambda: time.time() + 60)
+        response = self.fetch('/health')
+        assert response.code == 503
+        assert response.headers['Retry-After'] == '5'
+        assert self.app.admission.shed[LIGHT, QUEUE_TIME] == 1
+
+    def test_admitted_requests_are_released(self):
+        response = self.fetch('/health')
+        assert response.code == 200
+        assert self.app.admission.total_in_flight == 0
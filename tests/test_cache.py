@@ -0,0 +1,116 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from cyclence.cache import TTLCache
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestTTLCache(object):
+
+    def setup_method(self, method):
+        self.clock = Clock()
+        self.cache = TTLCache(60, max_size=3, clock=self.clock)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.clock.now += 60
+        assert self.cache.get('a') == 1
+        self.clock.now += 1
+        assert self.cache.get('a') is None
+        assert 'a' not in self.cache
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate('a')
+        self.cache.invalidate('missing')
+        assert self.cache.get('a') is None
+        assert self.cache.get('b') == 2
+
+    def test_oldest_are_dropped(self):
+        for i, key in enumerate('abcd'):
+            self.cache.set(key, i)
+        assert len(self.cache) == 3
+        assert self.cache.get('a') is None
+        assert self.cache.keys() == ['b', 'c', 'd']
+
+    def test_setting_again_renews(self):
+        self.cache.set('a', 1)
+        self.clock.now += 50
+        self.cache.set('a', 2)
+        self.clock.now += 50
+        assert self.cache.get('a') == 2
+
+main = pytest.importorskip('cyclence.website.main')
+
+class TestUserCookie(object):
+
+    def test_round_trip(self):
+        class User(object):
+            email = 'a@x.com'
+            name = 'Alice'
+        profile = main.parse_user_cookie(main.user_cookie(User()))
+        assert (profile['email'], profile['name']) == ('a@x.com', 'Alice')
+
+    def test_old_cookies_are_just_the_email(self):
+        assert main.parse_user_cookie('a@x.com') == dict(email='a@x.com')
+
+    def test_other_versions_are_ignored(self):
+        cookie = main.escape.json_encode(dict(v=main.COOKIE_VERSION + 1,
+                                              email='a@x.com'))
+        assert main.parse_user_cookie(cookie) is None
+        assert main.parse_user_cookie('[1, 2]') is None
+        assert main.parse_user_cookie(None) is None
+
+class TestUserCache(object):
+
+    def app(self, monkeypatch):
+        # engines don't connect until they're used
+        monkeypatch.setenv('CYCLENCE_DB_CONNECTION_STRING',
+                           'postgresql://localhost/unused')
+        monkeypatch.delenv('CYCLENCE_DB_SHARDS', raising=False)
+        return main.CyclenceApp()
+
+    def test_cached_users_are_merged_without_loading(self, monkeypatch):
+        app = self.app(monkeypatch)
+        user = main.orm.User(email='a@x.com', name='Alice')
+        app.user_cache.set('a@x.com', user)
+        merged = []
+        class Session(object):
+            def merge(self, obj, load=True):
+                merged.append((obj, load))
+                return obj
+        assert app.load_user(Session(), 'a@x.com') is user
+        assert merged == [(user, False)]
+
+    def test_friend_and_profile_events_invalidate(self, monkeypatch):
+        app = self.app(monkeypatch)
+        for kind in (main.events.FRIENDS, main.events.PROFILE):
+            app.user_cache.set('a@x.com', object())
+            app.on_event(dict(kind=kind, email='a@x.com', ts=0))
+            assert 'a@x.com' not in app.user_cache
+        app.user_cache.set('a@x.com', object())
+        app.on_event(dict(kind=main.events.TASK, email='a@x.com', ts=0))
+        assert 'a@x.com' in app.user_cache
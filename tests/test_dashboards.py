@@ -0,0 +1,168 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from cyclence import dashboards
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+TODAY = date(2013, 6, 1)
+
+class Today(date):
+
+    day = TODAY
+
+    @classmethod
+    def today(cls):
+        return cls.day
+
+class IOLoop(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+
+class Session(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestDashboards(object):
+
+    def setup_method(self, method):
+        self.built = []
+        self.opened = []
+        def dashboard(sessions, email, day):
+            self.built.append((email, day))
+            return ['{} {}'.format(email, day)]
+        def sessions_for(email):
+            sessions = [Session(), Session()]
+            self.opened.extend(sessions)
+            return sessions
+        self.saved = dashboards.dashboard, dashboards.date
+        dashboards.dashboard, dashboards.date = dashboard, Today
+        Today.day = TODAY
+        self.io_loop = IOLoop()
+        self.d = dashboards.Dashboards(sessions_for, self.io_loop)
+
+    def teardown_method(self, method):
+        dashboards.dashboard, dashboards.date = self.saved
+
+    def test_lists_are_kept_per_user_and_day(self):
+        assert self.d.get([], 'a@x.com') == ['a@x.com 2013-06-01']
+        assert self.d.get([], 'a@x.com') == ['a@x.com 2013-06-01']
+        assert self.d.get([], 'b@x.com') == ['b@x.com 2013-06-01']
+        assert self.built == [('a@x.com', TODAY), ('b@x.com', TODAY)]
+
+    def test_forget_drops_today_and_tomorrow(self):
+        tomorrow = TODAY + timedelta(1)
+        self.d.get([], 'a@x.com')
+        self.d.get([], 'b@x.com')
+        self.d.warm('a@x.com', tomorrow)
+        self.d.forget('a@x.com')
+        assert ('a@x.com', TODAY) not in self.d.cache
+        assert ('a@x.com', tomorrow) not in self.d.cache
+        assert ('b@x.com', TODAY) in self.d.cache
+
+    def test_rollover_warms_tomorrow_for_active_users(self):
+        tomorrow = TODAY + timedelta(1)
+        self.d.get([], 'a@x.com')
+        self.d.get([], 'b@x.com')
+        del self.built[:]
+        self.d.rollover()
+        # one warm up per active user, then the next rollover
+        warm_ups, (_, next_rollover) = self.io_loop.timeouts[:-1], \
+            self.io_loop.timeouts[-1]
+        assert next_rollover == self.d.rollover
+        assert len(warm_ups) == 2
+        for _, callback in warm_ups:
+            callback()
+        assert sorted(self.built) == [('a@x.com', tomorrow),
+                                      ('b@x.com', tomorrow)]
+        assert all(session.closed for session in self.opened)
+        # at midnight they're already there
+        Today.day = tomorrow
+        assert self.d.get([], 'a@x.com') == ['a@x.com 2013-06-02']
+        assert len(self.built) == 2
+
+def test_task_events_forget_the_user(monkeypatch):
+    from cyclence.website import main
+    monkeypatch.setenv('CYCLENCE_DB_CONNECTION_STRING',
+                       'postgresql://localhost/unused')
+    monkeypatch.delenv('CYCLENCE_DB_SHARDS', raising=False)
+    app = main.CyclenceApp()
+    app.dashboards.cache.set(('a@x.com', date.today()), [])
+    app.on_event(dict(kind=main.events.TASK, email='a@x.com', ts=0))
+    assert ('a@x.com', date.today()) not in app.dashboards.cache
+
+@pytest.mark.skipif(DB is None, reason='needs a scratch postgres database in '
+                    'CYCLENCE_TEST_DB_CONNECTION_STRING')
+class TestTaskEvents(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from cyclence.Calendaring import CyclenceBase
+        from cyclence.migrations import schema_version, upgrade
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+        upgrade(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.listener = self.engine.raw_connection()
+        self.listener.connection.autocommit = True
+        self.listener.cursor().execute('LISTEN cyclence_events')
+
+    def teardown_method(self, method):
+        self.listener.close()
+        self.session.close()
+        self.drop()
+
+    def received(self):
+        conn = self.listener.connection
+        conn.poll()
+        events = [json.loads(n.payload) for n in conn.notifies]
+        del conn.notifies[:]
+        return sorted((e['email'], e['kind']) for e in events)
+
+    def test_changed_tells_everyone_sharing_the_task(self):
+        from cyclence.Calendaring import User, Task
+        a = User(email='a@x.com', name='A')
+        b = User(email='b@x.com', name='B')
+        task = Task('Shared', 7, date.today())
+        a.tasks.append(task)
+        b.tasks.append(task)
+        self.session.add_all([a, b])
+        self.session.flush()
+        task.changed()
+        assert self.received() == [] # not until the commit
+        self.session.commit()
+        assert self.received() == [('a@x.com', 'task'), ('b@x.com', 'task')]
+        task.changed(emails=['a@x.com'])
+        self.session.commit()
+        assert self.received() == [('a@x.com', 'task')]
@@ -0,0 +1,140 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import shutil
+import tempfile
+from datetime import date
+from uuid import uuid4
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from cyclence import eventlog
+from cyclence.eventlog import (EventLog, pack, user_key, COMPLETED,
+                               UNCOMPLETED, TASK_DELETED, USER_DELETED)
+
+class TestEventLog(object):
+
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.log = EventLog(self.directory, segment_size=eventlog.RECORD.size * 3)
+        self.tasks = [str(uuid4()) for _ in range(3)]
+
+    def teardown_method(self, method):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def complete(self, task, email, day, points):
+        self.log.append([pack(COMPLETED, task, email, date(2013, 5, day),
+                              points, 0)])
+
+    def test_records_round_trip(self):
+        self.log.append([pack(COMPLETED, self.tasks[0], 'a@x.com',
+                              date(2013, 5, 1), 80, -2)])
+        self.log.close()
+        records = list(eventlog.replay(self.directory))
+        assert len(records) == 1
+        assert records[0] == (COMPLETED, self.tasks[0], user_key('a@x.com'),
+                              date(2013, 5, 1).toordinal(), 80, -2)
+
+    def test_rotates_segments_by_size(self):
+        for day in range(1, 8):
+            self.complete(self.tasks[0], 'a@x.com', day, 10)
+        self.log.close()
+        assert len(eventlog.segments(self.directory)) == 3
+        assert [r.day for r in eventlog.replay(self.directory)] == \
+            [date(2013, 5, day).toordinal() for day in range(1, 8)]
+
+    def test_ignores_partly_written_record(self):
+        self.complete(self.tasks[0], 'a@x.com', 1, 10)
+        self.log.segment.write(b'\x01\x00\x00')
+        self.log.close()
+        assert len(list(eventlog.replay(self.directory))) == 1
+
+    def test_deletions_remove_points(self):
+        self.complete(self.tasks[0], 'a@x.com', 1, 10)
+        self.complete(self.tasks[0], 'B@x.com', 2, 20)
+        self.complete(self.tasks[1], 'a@x.com', 3, 30)
+        self.complete(self.tasks[2], 'b@x.com', 4, 40)
+        self.complete(self.tasks[2], 'c@x.com', 5, 50)
+        self.log.append([
+            pack(UNCOMPLETED, self.tasks[0], 'a@x.com', date(2013, 5, 1), 10),
+            pack(TASK_DELETED, self.tasks[1]),
+            pack(USER_DELETED, email='c@x.com'),
+        ])
+        self.log.close()
+        assert eventlog.points_by_user(self.directory) == \
+            {user_key('b@x.com'): 60}
+        # deleted users' completions stay, by nobody
+        history = eventlog.completions(self.directory)[self.tasks[2]]
+        assert sorted((r.day, r.user, r.points) for r in history.values()) == \
+            [(date(2013, 5, 4).toordinal(), user_key('b@x.com'), 40),
+             (date(2013, 5, 5).toordinal(), 0, 50)]
+
+    def test_users_completions_after_their_deletion_count(self):
+        self.complete(self.tasks[0], 'a@x.com', 1, 10)
+        self.log.append([pack(USER_DELETED, email='a@x.com')])
+        self.complete(self.tasks[0], 'a@x.com', 2, 20)
+        self.log.close()
+        assert eventlog.points_by_user(self.directory) == \
+            {user_key('a@x.com'): 20}
+
+    def test_matches_replaying_one_record_at_a_time(self):
+        import random
+        random.seed(4)
+        emails = ['a@x.com', 'b@x.com', 'c@x.com']
+        records = []
+        for _ in range(2000):
+            kind = random.choice([COMPLETED] * 6 + [UNCOMPLETED] * 2 +
+                                 [TASK_DELETED, USER_DELETED])
+            task = random.choice(self.tasks)
+            email = random.choice(emails)
+            day = date(2013, 5, random.randint(1, 5))
+            if kind == TASK_DELETED:
+                records.append(pack(kind, task, day=day))
+            elif kind == USER_DELETED:
+                records.append(pack(kind, email=email, day=day))
+            else:
+                records.append(pack(kind, task, email, day,
+                                    random.randint(0, 100)))
+        self.log.segment_size = eventlog.RECORD.size * 500
+        self.log.append(records[:1000])
+        self.log.append(records[1000:])
+        self.log.close()
+        expected = {}
+        for r in eventlog.replay(self.directory):
+            if r.kind == COMPLETED:
+                expected[r.task_id, r.day] = r
+            elif r.kind == UNCOMPLETED:
+                expected.pop((r.task_id, r.day), None)
+            elif r.kind == TASK_DELETED:
+                expected = dict((k, v) for k, v in expected.items()
+                                if k[0] != r.task_id)
+            elif r.kind == USER_DELETED:
+                expected = dict((k, v._replace(user=0) if v.user == r.user
+                                 else v) for k, v in expected.items())
+        found = dict(((task_id, day), record)
+                     for task_id, history in
+                     eventlog.completions(self.directory).items()
+                     for day, record in history.items())
+        assert found == expected
+        totals = {}
+        for r in expected.values():
+            if r.user:
+                totals[r.user] = totals.get(r.user, 0) + r.points
+        assert eventlog.points_by_user(self.directory) == totals
@@ -0,0 +1,152 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from cyclence.events import EventListener
+
+class FakeConnection(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.notifies = []
+        self.broken = False
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def set_isolation_level(self, level):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.sql = sql
+
+    def poll(self):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+
+    def close(self):
+        self.closed = True
+
+class FakeEngine(object):
+    r'''Hands out a new connection each time, or fails while `down`'''
+
+    def __init__(self):
+        self.conns = []
+        self.down = False
+
+    def raw_connection(self):
+        if self.down:
+            raise psycopg2.OperationalError('could not connect')
+        engine = self
+        class Raw(object):
+            connection = FakeConnection(100 + len(engine.conns))
+            def detach(self):
+                pass
+        self.conns.append(Raw.connection)
+        return Raw()
+
+class FakeIOLoop(object):
+    READ = 1
+
+    def __init__(self):
+        self.handlers = {}
+        self.timeouts = []
+
+    def add_handler(self, fd, handler, events):
+        self.handlers[fd] = handler
+
+    def remove_handler(self, fd):
+        del self.handlers[fd]
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append(callback)
+
+    def run_timeouts(self):
+        timeouts, self.timeouts = self.timeouts, []
+        for callback in timeouts:
+            callback()
+
+class TestReconnect(object):
+
+    def setup_method(self, method):
+        self.engine = FakeEngine()
+        self.io_loop = FakeIOLoop()
+        self.listener = EventListener([self.engine], self.io_loop)
+        self.events = []
+        self.reconnects = []
+        self.listener.add_handler(self.events.append)
+        self.listener.add_reconnect_handler(
+            lambda: self.reconnects.append(True))
+        self.listener.start()
+
+    def notify(self, conn, **event):
+        class Notify(object):
+            payload = json.dumps(dict(event, email='a@x.com', ts=0))
+        conn.notifies.append(Notify())
+        self.io_loop.handlers[conn.fd](conn.fd, self.io_loop.READ)
+
+    def test_reconnects_after_losing_the_connection(self):
+        first = self.engine.conns[0]
+        first.broken = True
+        self.io_loop.handlers[first.fd](first.fd, self.io_loop.READ)
+        assert first.closed
+        assert first.fd not in self.io_loop.handlers
+        second = self.engine.conns[1]
+        assert second.sql == 'LISTEN cyclence_events'
+        assert self.reconnects == [True]
+        self.notify(second, kind='task')
+        assert [e['kind'] for e in self.events] == ['task']
+
+    def test_backs_off_while_the_database_is_down(self):
+        first = self.engine.conns[0]
+        first.broken = True
+        self.engine.down = True
+        self.io_loop.handlers[first.fd](first.fd, self.io_loop.READ)
+        self.io_loop.run_timeouts()
+        assert self.io_loop.handlers == {}
+        assert self.reconnects == []
+        assert len(self.io_loop.timeouts) == 1
+        self.engine.down = False
+        self.io_loop.run_timeouts()
+        assert list(self.io_loop.handlers) == [self.engine.conns[1].fd]
+        assert self.reconnects == [True]
+
+    def test_a_failing_handler_doesnt_stop_the_rest(self, caplog):
+        def boom(*args):
+            raise RuntimeError('boom')
+        listener = EventListener([self.engine], self.io_loop)
+        events, waited = [], []
+        listener.add_handler(boom)
+        listener.add_handler(events.append)
+        listener.subscribe('a@x.com', 0, boom)
+        listener.subscribe('a@x.com', 0, lambda got: waited.extend(got))
+        listener.start()
+        self.notify(self.engine.conns[-1], kind='task')
+        assert [e['kind'] for e in events] == ['task']
+        assert [e['kind'] for e in waited] == ['task']
+        failures = [r for r in caplog.records if r.exc_info]
+        assert len(failures) == 2
+        assert all(str(r.exc_info[1]) == 'boom' for r in failures)
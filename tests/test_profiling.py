@@ -0,0 +1,113 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+import pytest
+
+testing = pytest.importorskip('tornado.testing')
+
+from tornado import web
+
+from cyclence import profiling
+from cyclence.profiling import Profiler, StackSampler, HEADER, profile_token
+
+SECRET = 'secret'
+
+class Request(object):
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+def profiled(token):
+    return Request(**{HEADER: token})
+
+class TestWanted(object):
+
+    def test_nothing_without_a_directory(self):
+        profiler = Profiler(None, rate=1.0, secret=SECRET)
+        assert not profiler.wanted(profiled(profile_token(SECRET)))
+
+    def test_samples_at_the_rate(self, tmpdir, monkeypatch):
+        profiler = Profiler(str(tmpdir), rate=0.25, secret=SECRET)
+        draws = iter([0.1, 0.3, 0.24, 0.9])
+        monkeypatch.setattr(profiling.random, 'random', lambda: next(draws))
+        assert [profiler.wanted(Request()) for _ in range(4)] == \
+            [True, False, True, False]
+        assert not Profiler(str(tmpdir), rate=0.0).wanted(Request())
+
+    def test_one_profile_at_a_time(self, tmpdir):
+        profiler = Profiler(str(tmpdir), rate=1.0)
+        profiler.running = True
+        assert not profiler.wanted(Request())
+
+    def test_signed_header_is_always_profiled(self, tmpdir):
+        profiler = Profiler(str(tmpdir), rate=0.0, secret=SECRET)
+        assert profiler.wanted(profiled(profile_token(SECRET)))
+
+    def test_forged_headers_are_not(self, tmpdir):
+        profiler = Profiler(str(tmpdir), rate=0.0, secret=SECRET)
+        for token in (profile_token('guessed'),
+                      web.create_signed_value(SECRET, 'user', 'admin'),
+                      'admin', profile_token(SECRET)[:-1]):
+            assert not profiler.wanted(profiled(token))
+
+    def test_expired_headers_are_not(self, tmpdir, monkeypatch):
+        profiler = Profiler(str(tmpdir), rate=0.0, secret=SECRET)
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now - 2 * 86400)
+        token = profile_token(SECRET)
+        monkeypatch.setattr(time, 'time', lambda: now)
+        assert not profiler.wanted(profiled(token))
+
+class TestRotate(object):
+
+    def test_keeps_the_newest(self, tmpdir):
+        profiler = Profiler(str(tmpdir), keep=2)
+        for i in range(4):
+            for ext in ('.pstats', '.collapsed'):
+                path = tmpdir.join('{}{}'.format(i, ext))
+                path.write('')
+                os.utime(str(path), (1000 + i, 1000 + i))
+        profiler.rotate()
+        assert sorted(p.basename for p in tmpdir.listdir()) == \
+            ['2.collapsed', '2.pstats', '3.collapsed', '3.pstats']
+
+def test_samples_cpu_time():
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    try:
+        start = os.times()[0]
+        while os.times()[0] - start < 0.05:
+            pass
+    finally:
+        sampler.stop()
+    assert any('test_samples_cpu_time' in stack for stack in sampler.stacks)
+
+def test_writes_a_profile_and_a_flamegraph(tmpdir):
+    profiler = Profiler(str(tmpdir), rate=1.0)
+    run = profiler.start()
+    assert not profiler.wanted(Request())
+    sum(range(100000))
+    class Finished(object):
+        method = 'GET'
+        path = '/tasks/next'
+    profiler.finish(run, Finished(), 200)
+    assert profiler.wanted(Request())
+    assert sorted(p.ext for p in tmpdir.listdir()) == ['.collapsed', '.pstats']
+    assert all('-GET-tasks_next-200.' in p.basename for p in tmpdir.listdir())
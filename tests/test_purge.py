@@ -0,0 +1,105 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from datetime import date, timedelta
+
+import pytest
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(DB is None, reason='needs a scratch postgres '
+                                'database in CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+class TestPurgeUsers(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from cyclence.Calendaring import CyclenceBase, User, Task
+        from cyclence.migrations import schema_version, upgrade
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+        upgrade(self.engine)
+        session = sessionmaker(bind=self.engine)()
+        a = User(email='a@x.com', name='A')
+        b = User(email='b@x.com', name='B')
+        shared = Task('Shared', 7, date.today() - timedelta(10))
+        own = Task('Own', 7, date.today() - timedelta(10))
+        a.tasks.append(shared)
+        b.tasks.extend([shared, own])
+        session.add_all([a, b])
+        session.flush()
+        shared.complete(a, date.today() - timedelta(3))
+        shared.complete(b, date.today() - timedelta(1))
+        own.complete(b, date.today() - timedelta(2))
+        session.commit()
+        self.shared, self.own = shared.task_id, own.task_id
+        session.close()
+
+    def teardown_method(self, method):
+        self.drop()
+
+    def test_shared_tasks_keep_their_completions(self):
+        from cyclence import purge
+        from cyclence.Calendaring import Task
+        from cyclence.views import task_views
+        from sqlalchemy.orm import sessionmaker
+        assert purge.purge_users(self.engine, ['b@x.com'], batch=1) == 1
+        session = sessionmaker(bind=self.engine)()
+        try:
+            assert [t.task_id for t in session.query(Task)] == [self.shared]
+            task, = task_views(session, 'a@x.com')
+            assert task.last_completed == date.today() - timedelta(1)
+            assert [c.completer_name for c in task.completions] == ['A', None]
+            assert [u.email for u in task.users] == ['a@x.com']
+        finally:
+            session.close()
+
+    def test_event_log_agrees_with_the_database(self):
+        import shutil
+        import tempfile
+        from cyclence import purge, eventlog
+        from cyclence.Calendaring import Completion
+        from sqlalchemy.orm import sessionmaker
+        directory = tempfile.mkdtemp()
+        log = eventlog.EventLog(directory)
+        try:
+            def stored():
+                session = sessionmaker(bind=self.engine)()
+                try:
+                    return sorted(session.query(Completion))
+                finally:
+                    session.close()
+            log.append([eventlog.completion_record(eventlog.COMPLETED, c)
+                        for c in stored()])
+            purge.purge_users(self.engine, ['b@x.com'], log=log)
+            log.close()
+            expected = sorted((c.task_id, c.completed_on.toordinal(),
+                               eventlog.user_key(c.email) if c.email else 0)
+                              for c in stored())
+            found = sorted((task_id, day, record.user)
+                           for task_id, history
+                           in eventlog.completions(directory).items()
+                           for day, record in history.items())
+            assert found == expected
+            assert len(found) == 2
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,51 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(DB is None, reason='needs a scratch postgres '
+                                'database in CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+class TestQueryPlans(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from cyclence import queryplans
+        from cyclence.Calendaring import CyclenceBase
+        from cyclence.migrations import schema_version
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        queryplans.seed(self.engine)
+
+    def teardown_method(self, method):
+        self.drop()
+
+    def test_hot_queries_use_indexes(self):
+        from cyclence import queryplans
+        assert queryplans.check(self.engine) == []
+
+    def test_relations_without_statistics_are_skipped(self, monkeypatch):
+        from cyclence import queryplans
+        monkeypatch.setattr(queryplans, 'seq_scans',
+                            lambda plan: iter(['no_such_relation']))
+        assert queryplans.check(self.engine) == []
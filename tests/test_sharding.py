@@ -0,0 +1,231 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from datetime import date
+
+import pytest
+
+from cyclence.sharding import shard_of, ShardRouter
+
+SHARDS = os.getenv('CYCLENCE_TEST_DB_SHARDS', '').split()
+
+needs_shards = pytest.mark.skipif(
+    len(SHARDS) < 2, reason='needs two or more scratch postgres databases in '
+    'CYCLENCE_TEST_DB_SHARDS')
+
+def test_shard_of_is_stable():
+    assert shard_of('a@x.com', 1) == 0
+    assert shard_of('Someone@X.com ', 4) == shard_of('someone@x.com', 4)
+    shards = set(shard_of('user{}@x.com'.format(i), 4) for i in range(100))
+    assert shards == set(range(4))
+
+def test_emails_are_hashed_the_same_everywhere():
+    from hashlib import md5
+    from cyclence import utils, eventlog
+    digest = md5(b'someone@x.com').hexdigest()
+    assert utils.gravatar_hash(' Someone@X.com') == digest
+    assert eventlog.user_key('Someone@X.com') == \
+        eventlog.user_key('someone@x.com')
+    assert shard_of('Someone@X.com', 7) == int(digest[:8], 16) % 7
+
+def test_task_ids_are_on_their_owners_shard():
+    router = ShardRouter(['postgresql://localhost/a', 'postgresql://localhost/b',
+                          'postgresql://localhost/c'])
+    for email in ('a@x.com', 'b@x.com', 'c@x.com'):
+        task_id = router.task_id_for(email)
+        assert router.shard_of(task_id) == router.shard_of(email)
+
+@needs_shards
+class TestCrossShard(object):
+
+    def setup_method(self, method):
+        from cyclence.Calendaring import CyclenceBase, User
+        from cyclence.migrations import schema_version, upgrade
+        self.router = ShardRouter(SHARDS)
+        self.drop = lambda: [(CyclenceBase.metadata.drop_all(engine),
+                              schema_version.drop(engine, checkfirst=True))
+                             for engine in self.router.engines]
+        self.drop()
+        for engine in self.router.engines:
+            CyclenceBase.metadata.create_all(engine)
+            upgrade(engine)
+        # two users who live on different shards
+        emails = ('user{}@x.com'.format(i) for i in range(100))
+        self.a = next(emails)
+        self.b = next(e for e in emails
+                      if self.router.shard_of(e) != self.router.shard_of(self.a))
+        for email, name in ((self.a, 'A'), (self.b, 'B')):
+            session = self.router.session_for(email)
+            session.add(User(email=email, name=name))
+            session.commit()
+            session.close()
+        self.sessions = []
+
+    def teardown_method(self, method):
+        for session in self.sessions:
+            session.close()
+        self.drop()
+
+    def session_for(self, email):
+        session = self.router.session_for(email)
+        self.sessions.append(session)
+        return session
+
+    def test_friendships_are_stored_on_both_shards(self):
+        from cyclence.Calendaring import User
+        from cyclence.sharding import find_user
+        from cyclence.views import friend_views
+        session = self.session_for(self.a)
+        a = session.query(User).get(self.a)
+        a.add_friend(find_user(session, self.b))
+        session.commit()
+        assert [f.name for f in friend_views(self.session_for(self.a),
+                                             self.a)] == ['B']
+        assert [f.name for f in friend_views(self.session_for(self.b),
+                                             self.b)] == ['A']
+
+    def test_notifications_go_to_the_recipients_shard(self):
+        from cyclence.Calendaring import Notification
+        session = self.session_for(self.a)
+        Notification.send(session, [self.a, self.b], 'message', 'hi',
+                          sender=self.a)
+        session.commit()
+        for email in (self.a, self.b):
+            notes = self.session_for(email).query(Notification).all()
+            assert [(n.email, n.sender) for n in notes] == [(email, self.a)]
+
+    def test_shared_tasks_are_listed_from_every_shard(self):
+        from cyclence.Calendaring import Task, User
+        from cyclence.sharding import link
+        from cyclence.views import all_task_views
+        session = self.session_for(self.a)
+        task = Task('Feed cat', 3, date.today())
+        task.task_id = self.router.task_id_for(self.a)
+        a = session.query(User).get(self.a)
+        a.tasks.append(task)
+        task.users.append(User.ghost(session, self.b, 'B'))
+        session.commit()
+        home = self.session_for(self.b)
+        link(home, self.b, self.router.shard_of(self.a))
+        home.commit()
+        sessions = self.router.sessions_for(self.b)
+        self.sessions.extend(sessions)
+        assert [t.name for t in all_task_views(sessions, self.b)] == \
+            ['Feed cat']
+
+    def test_sync_covers_every_shard(self):
+        from cyclence.Calendaring import Task, User, TASK_ENTITY
+        from cyclence.sharding import link
+        from cyclence.sync import sync_all, parse_cursors
+        session = self.session_for(self.a)
+        task = Task('Feed cat', 3, date.today())
+        task.task_id = self.router.task_id_for(self.a)
+        a = session.query(User).get(self.a)
+        a.tasks.append(task)
+        task.users.append(User.ghost(session, self.b, 'B'))
+        session.commit()
+        home = self.session_for(self.b)
+        b = home.query(User).get(self.b)
+        b.tasks.append(Task('Water plants', 7, date.today()))
+        link(home, self.b, self.router.shard_of(self.a))
+        home.commit()
+
+        def sync(cursor=None):
+            sessions = self.router.sessions_for(self.b)
+            self.sessions.extend(sessions)
+            delta = sync_all(sessions, self.b, cursor)
+            for s in sessions:
+                s.commit()
+            return delta
+
+        delta = sync()
+        assert delta.reset
+        assert sorted(t.name for t in delta.tasks) == \
+            ['Feed cat', 'Water plants']
+        assert sorted(parse_cursors(delta.cursor)) == [0, 1]
+        delta = sync(delta.cursor)
+        assert not delta.reset and delta.tasks == []
+
+        task.name = 'Feed the cat'
+        session.commit()
+        delta = sync(delta.cursor)
+        assert not delta.reset
+        assert [t.name for t in delta.tasks] == ['Feed the cat']
+
+        task.users.remove(session.query(User).get(self.b))
+        session.commit()
+        delta = sync(delta.cursor)
+        assert delta.removed[TASK_ENTITY] == [task.task_id]
+
+        # a cursor from before shards had their own starts again
+        assert sync('1:0').reset
+
+    def test_sync_resets_every_shard_together(self):
+        from cyclence.Calendaring import User, purged_changes
+        from cyclence.sharding import link
+        from cyclence.sync import sync_all, parse_cursors
+        home = self.session_for(self.b)
+        link(home, self.b, self.router.shard_of(self.a))
+        home.commit()
+        sessions = self.router.sessions_for(self.b)
+        self.sessions.extend(sessions)
+        cursor = sync_all(sessions, self.b).cursor
+        for s in sessions:
+            s.commit()
+        # everything the other shard had is purged
+        txid = int(parse_cursors(cursor)[self.router.shard_of(self.a)]
+                   .split(':')[0])
+        other = self.session_for(self.a)
+        other.execute(purged_changes.insert(), dict(txid=txid))
+        other.commit()
+        assert sync_all(sessions, self.b, cursor).reset
+
+    def test_suggestions_count_every_shard(self):
+        from cyclence.Calendaring import Task, User
+        from cyclence.sharding import link, find_user
+        from cyclence.suggestions import Suggestions
+        # c lives with b, away from a
+        c = next('other{}@x.com'.format(i) for i in range(100)
+                 if self.router.shard_of('other{}@x.com'.format(i)) ==
+                 self.router.shard_of(self.b))
+        away = self.session_for(self.b)
+        away.add(User(email=c, name='C'))
+        away.commit()
+        home = self.session_for(self.a)
+        a = home.query(User).get(self.a)
+        a.add_friend(find_user(home, self.b))
+        home.commit()
+        b, c_user = away.query(User).get(self.b), away.query(User).get(c)
+        b.add_friend(c_user)
+        task = Task('Feed cat', 3, date.today())
+        task.task_id = self.router.task_id_for(c)
+        c_user.tasks.append(task)
+        task.users.append(User.ghost(away, self.a, 'A'))
+        away.commit()
+        link(home, self.a, self.router.shard_of(c))
+        home.commit()
+        sessions = self.router.sessions_for(self.a)
+        self.sessions.extend(sessions)
+        suggestions = Suggestions(self.router.shard_of)
+        def session_on(shard):
+            session = self.router.session(shard)
+            self.sessions.append(session)
+            return session
+        ranked = suggestions.get(sessions, self.a, session_on=session_on)
+        assert [(s.email, s.name, s.mutual, s.shared) for s in ranked] == \
+            [(c, 'C', 1, 1)]
@@ -0,0 +1,106 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+from datetime import date
+
+import pytest
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(DB is None, reason='needs a scratch postgres '
+                                'database in CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+EMAILS = ['user{}@x.com'.format(i) for i in range(12)]
+
+class TestSuggestions(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from cyclence.Calendaring import CyclenceBase, User, Task
+        from cyclence.migrations import schema_version, upgrade
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+        upgrade(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+        self.users = dict((e, User(email=e, name=e.split('@')[0]))
+                          for e in EMAILS)
+        self.session.add_all(self.users.values())
+        rnd = random.Random(2)
+        for _ in range(4):
+            task = Task('Shared', 7, date.today())
+            for email in rnd.sample(EMAILS, 3):
+                self.users[email].tasks.append(task)
+        self.session.commit()
+        self.rnd = rnd
+
+    def teardown_method(self, method):
+        self.session.close()
+        self.drop()
+
+    def befriend(self, a, b):
+        self.users[a].add_friend(self.users[b])
+        self.session.commit()
+
+    def test_new_friendships_drop_what_they_change(self):
+        from cyclence.suggestions import Suggestions, candidates, friends_of
+        pairs = [(a, b) for i, a in enumerate(EMAILS) for b in EMAILS[i + 1:]]
+        self.rnd.shuffle(pairs)
+        for a, b in pairs[:10]:
+            self.befriend(a, b)
+        suggestions = Suggestions()
+        for a, b in pairs[10:30]:
+            for email in EMAILS:
+                suggestions.get([self.session], email)
+            self.befriend(a, b)
+            suggestions.befriended(a, b)
+            assert a not in suggestions.cache and b not in suggestions.cache
+            # what's left is still right, and the rest is looked up again
+            kept = suggestions.cache.keys()
+            for email in EMAILS:
+                if email not in kept:
+                    suggestions.get([self.session], email)
+                friends, scores = suggestions.cache.get(email)
+                assert friends == friends_of(self.session, email)
+                assert scores == candidates(self.session, email), email
+
+    def test_ranked_by_mutual_friends_then_shared_tasks(self):
+        from cyclence.suggestions import Suggestions
+        a, b, c, d = EMAILS[:4]
+        self.befriend(a, b)
+        self.befriend(a, c)
+        self.befriend(b, d)
+        self.befriend(c, d)
+        suggestions = Suggestions()
+        ranked = suggestions.get([self.session], a)
+        assert ranked[0].email == d and ranked[0].mutual == 2
+        assert [(s.mutual, s.shared) for s in ranked] == \
+            sorted([(s.mutual, s.shared) for s in ranked], reverse=True)
+        assert not set([a, b, c]) & set(s.email for s in ranked)
+
+    def test_users_without_friends(self):
+        from cyclence.suggestions import candidates
+        for email in EMAILS:
+            scores = candidates(self.session, email)
+            assert all(mutual == 0 and shared > 0
+                       for mutual, shared in scores.values())
@@ -0,0 +1,173 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from datetime import date
+
+import pytest
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(DB is None, reason='needs a scratch postgres '
+                                'database in CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+class TestSync(object):
+
+    def setup_method(self, method):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from cyclence.Calendaring import CyclenceBase, User
+        from cyclence.migrations import schema_version, upgrade
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+        upgrade(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.a = User(email='a@x.com', name='A')
+        self.b = User(email='b@x.com', name='B')
+        self.session.add_all([self.a, self.b])
+        self.session.commit()
+
+    def teardown_method(self, method):
+        self.session.close()
+        self.drop()
+
+    def sync(self, cursor=None):
+        from cyclence.sync import sync
+        delta = sync(self.session, 'a@x.com', cursor)
+        self.session.commit()
+        return delta
+
+    def test_without_a_cursor_everything_is_sent(self):
+        from cyclence.Calendaring import Task
+        self.a.tasks.append(Task('Water plants', 7, date.today()))
+        self.session.commit()
+        delta = self.sync()
+        assert delta.reset
+        assert [t.name for t in delta.tasks] == ['Water plants']
+
+    def test_create_rename_and_delete(self):
+        from cyclence.Calendaring import Task, TASK_ENTITY
+        cursor = self.sync().cursor
+        task = Task('Water plants', 7, date.today())
+        self.a.tasks.append(task)
+        self.session.commit()
+        task_id = task.task_id
+        delta = self.sync(cursor)
+        assert not delta.reset
+        assert [t.name for t in delta.tasks] == ['Water plants']
+        cursor = delta.cursor
+
+        task.name = 'Water the plants'
+        self.session.commit()
+        delta = self.sync(cursor)
+        assert [t.name for t in delta.tasks] == ['Water the plants']
+        assert delta.removed[TASK_ENTITY] == []
+        cursor = delta.cursor
+
+        self.session.delete(task)
+        self.session.commit()
+        delta = self.sync(cursor)
+        assert delta.tasks == []
+        assert delta.removed[TASK_ENTITY] == [task_id]
+        # nothing new since
+        delta = self.sync(delta.cursor)
+        assert delta.tasks == [] and delta.removed[TASK_ENTITY] == []
+
+    def test_notifications_and_friends(self):
+        cursor = self.sync().cursor
+        self.a.add_friend(self.b)
+        self.a.notify('message', 'Hello')
+        self.session.commit()
+        delta = self.sync(cursor)
+        assert [f.email for f in delta.friends] == ['b@x.com']
+        assert [n.message for n in delta.notifications] == ['Hello']
+
+    def test_purged_cursor_gets_everything_again(self):
+        from cyclence.Calendaring import Task
+        from cyclence.purge import purge_changes
+        self.a.tasks.append(Task('Water plants', 7, date.today()))
+        self.session.commit()
+        cursor = self.sync(self.sync().cursor).cursor
+        self.a.tasks.append(Task('Feed cat', 1, date.today()))
+        self.session.commit()
+        # every change so far is older than tomorrow
+        assert purge_changes(self.engine, -1) > 0
+        self.a.tasks.append(Task('Pay rent', 30, date.today()))
+        self.session.commit()
+        delta = self.sync(cursor)
+        assert delta.reset
+        assert sorted(t.name for t in delta.tasks) == \
+            ['Feed cat', 'Pay rent', 'Water plants']
+        # and carries on from there
+        assert not self.sync(delta.cursor).reset
+
+    def test_an_empty_log_is_not_purged(self):
+        cursor = self.sync().cursor
+        for _ in range(2):
+            delta = self.sync(cursor)
+            assert not delta.reset
+            assert delta.cursor == cursor
+
+    def test_a_fully_purged_log_carries_on(self):
+        from cyclence.Calendaring import Task
+        from cyclence.purge import purge_changes
+        self.a.tasks.append(Task('Water plants', 7, date.today()))
+        self.session.commit()
+        delta = self.sync(self.sync().cursor)
+        assert purge_changes(self.engine, -1) > 0
+        # only cursors from before the purge are reset
+        delta = self.sync(self.sync().cursor)
+        assert not delta.reset
+        assert not self.sync(delta.cursor).reset
+        self.a.tasks.append(Task('Feed cat', 1, date.today()))
+        self.session.commit()
+        delta = self.sync(delta.cursor)
+        assert not delta.reset
+        assert [t.name for t in delta.tasks] == ['Feed cat']
+
+    def test_everything_is_sent_a_page_at_a_time(self):
+        from cyclence.Calendaring import Task
+        from cyclence.sync import sync
+        names = ['Task {}'.format(i) for i in range(5)]
+        for name in names:
+            self.a.tasks.append(Task(name, 7, date.today()))
+        self.a.notify('message', 'Hello')
+        self.session.commit()
+        delta = sync(self.session, 'a@x.com', None, limit=2)
+        assert delta.reset and delta.more
+        assert len(delta.notifications) == 1
+        pages = [delta]
+        while delta.more:
+            delta = sync(self.session, 'a@x.com', delta.cursor, limit=2)
+            assert not delta.reset
+            assert delta.notifications == []
+            pages.append(delta)
+        assert [len(page.tasks) for page in pages] == [2, 2, 1]
+        assert sorted(t.name for page in pages for t in page.tasks) == names
+        # a change made while paging comes after the last page
+        self.a.tasks[0].name = 'Renamed'
+        self.session.commit()
+        delta = sync(self.session, 'a@x.com', delta.cursor, limit=2)
+        assert [t.name for t in delta.tasks] == ['Renamed']
+
+    def test_bad_cursor(self):
+        from cyclence.sync import InvalidCursor
+        with pytest.raises(InvalidCursor):
+            self.sync('yesterday')
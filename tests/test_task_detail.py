@@ -0,0 +1,130 @@
+# Copyright 2013 Josh Kuhn
+
+# This file is part of Cyclence.
+
+# Cyclence is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+
+# Cyclence is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for
+# more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with Cyclence.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from datetime import date, timedelta
+
+import pytest
+
+DB = os.getenv('CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(DB is None, reason='needs a scratch postgres '
+                                'database in CYCLENCE_TEST_DB_CONNECTION_STRING')
+
+testing = pytest.importorskip('tornado.testing')
+
+SECRET = 'secret'
+
+class TestTaskDetail(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from cyclence.Calendaring import CyclenceBase, User, Task
+        from cyclence.migrations import schema_version, upgrade
+        self.engine = create_engine(DB)
+        self.drop = lambda: (CyclenceBase.metadata.drop_all(self.engine),
+                             schema_version.drop(self.engine, checkfirst=True))
+        self.drop()
+        CyclenceBase.metadata.create_all(self.engine)
+        upgrade(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.a = User(email='a@x.com', name='Alice')
+        self.b = User(email='b@x.com', name='Bob')
+        self.c = User(email='c@x.com', name='Carol')
+        self.session.add_all([self.a, self.b, self.c])
+        self.task = Task('Water plants', 7, date.today() - timedelta(2),
+                         tags=['garden'], notes='the ferns')
+        self.a.tasks.append(self.task)
+        self.a.add_friend(self.b)
+        self.a.add_friend(self.c)
+        self.task.users.append(self.c)
+        self.session.commit()
+        self.task.complete(self.a, date.today() - timedelta(1))
+        self.session.commit()
+        self.task_id = self.task.task_id
+        testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        testing.AsyncHTTPTestCase.tearDown(self)
+        self.session.close()
+        self.drop()
+
+    def get_app(self):
+        from cyclence.website import main
+        saved = dict(os.environ)
+        os.environ['CYCLENCE_DB_CONNECTION_STRING'] = DB
+        os.environ['CYCLENCE_COOKIE_SECRET'] = SECRET
+        os.environ.pop('CYCLENCE_DB_SHARDS', None)
+        try:
+            return main.CyclenceApp()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+
+    def get(self, path, user):
+        from tornado import web
+        from cyclence.website import main
+        cookie = web.create_signed_value(SECRET, 'user',
+                                         main.user_cookie(user))
+        return self.fetch(path, headers={'Cookie': 'user=' + cookie},
+                          follow_redirects=False)
+
+    def test_detail_fragment_for_the_modal(self):
+        response = self.get('/tasks/{}'.format(self.task_id), self.a)
+        assert response.code == 200
+        # Cycl.showTask puts it straight into the modal
+        html = response.body.decode('utf-8')
+        assert '<html' not in html
+        for part in ('modal-header', 'modal-body', 'Water plants',
+                     'the ferns', 'Alice', 'Bob'):
+            assert part in html
+
+    def test_detail_as_json(self):
+        response = self.get('/tasks/{}?format=json'.format(self.task_id),
+                            self.a)
+        assert response.code == 200
+        detail = json.loads(response.body.decode('utf-8'))
+        assert detail['task_id'] == self.task_id
+        assert detail['name'] == 'Water plants'
+        assert detail['tags'] == ['garden']
+        assert [c['completer_name'] for c in detail['completions']] == \
+            ['Alice']
+        assert sorted(u['email'] for u in detail['users']) == \
+            ['a@x.com', 'c@x.com']
+        # friends who don't already share it
+        assert [f['email'] for f in detail['shareable']] == ['b@x.com']
+
+    def test_row_for_the_task_list(self):
+        response = self.get('/tasks/{}/row'.format(self.task_id), self.a)
+        assert response.code == 200
+        html = response.body.decode('utf-8')
+        assert 'data-task-detail="{}"'.format(self.task_id) in html
+        assert 'Water plants' in html
+
+    def test_other_users_tasks_are_not_found(self):
+        for path in ('/tasks/{}', '/tasks/{}?format=json', '/tasks/{}/row'):
+            response = self.get(path.format(self.task_id), self.b)
+            assert response.code == 404
+
+    def test_deleted_tasks_are_not_found(self):
+        self.session.delete(self.task)
+        self.session.commit()
+        for path in ('/tasks/{}', '/tasks/{}?format=json', '/tasks/{}/row'):
+            response = self.get(path.format(self.task_id), self.a)
+            assert response.code == 404